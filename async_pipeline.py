@@ -0,0 +1,211 @@
+import asyncio
+import time
+import traceback
+
+import aiohttp
+import asyncpraw
+
+import moderation
+from listing_poller import AsyncListingPoller
+from metrics import metrics
+from moderation import cache_toxicity, cached_toxicity, handle_comment, mark_comment_processed, \
+    mark_mod_actions_processed, new_comments, new_mod_actions, prefetch_targets, report_if_toxic, toxicity_score, \
+    toxicity_text
+from resilient_thread import ResilientThread
+from toxicity_scorer import ToxicityScorer
+
+
+class AsyncPipeline:
+    # runs the mod log and comment streams, sheets writes and toxicity scoring as coroutines on the discord loop,
+    # rather than a thread each. mod action handlers and reddit actions still run on their own pools, they mostly
+    # just enqueue work. nothing on the loop calls heartbeat(), instead each poll and each page's handling is timed
+    # out after the stall timeout, and the task restarted like a stalled ResilientThread
+    def __init__(self, discord_client, reddit_config, recorder, reddit_handler, subreddit_trackers, content_cache,
+                 handler_registry, author_status_cache, checkpoint_store, shadowban_ledger, toxicity_subreddits,
+                 toxicity_api_key, toxicity_cache, toxicity_prefilter, toxicity_workers, toxicity_queue_size,
+                 toxicity_drop_policy, budget_share=AsyncListingPoller.BUDGET_SHARE, flush_sheets=True,
+                 stall_timeout_secs=ResilientThread.STALL_TIMEOUT_SECS):
+        if toxicity_drop_policy not in ToxicityScorer.DROP_POLICIES:
+            raise ValueError(f"drop_policy must be one of {ToxicityScorer.DROP_POLICIES}")
+        self.discord_client = discord_client
+        # (client id, client secret, username, password), asyncpraw has to be created on the loop it's used from
+        self.reddit_config = reddit_config
+        self.recorder = recorder
+        self.reddit_handler = reddit_handler
+        self.subreddit_trackers = subreddit_trackers
+        self.content_cache = content_cache
+        self.handler_registry = handler_registry
+        self.author_status_cache = author_status_cache
+        self.checkpoint_store = checkpoint_store
+        self.shadowban_ledger = shadowban_ledger
+        self.toxicity_subreddits = toxicity_subreddits
+        self.toxicity_api_key = toxicity_api_key
+        self.toxicity_cache = toxicity_cache
+        self.toxicity_prefilter = toxicity_prefilter
+        self.toxicity_workers = toxicity_workers
+        self.toxicity_queue_size = toxicity_queue_size
+        self.toxicity_drop_policy = toxicity_drop_policy
+        self.budget_share = budget_share
+        # with several stream groups, only one of their pipelines flushes the shared recorder
+        self.flush_sheets = flush_sheets
+        self.stall_timeout_secs = stall_timeout_secs
+        self.reddit = None
+        self.session = None
+        self.toxicity_queue = None
+
+    def start(self):
+        self.discord_client.start_task(self.run)
+
+    async def run(self):
+        client_id, client_secret, bot_username, bot_password = self.reddit_config
+        self.reddit = asyncpraw.Reddit(client_id=client_id, client_secret=client_secret,
+                                       user_agent="flyio:com.subredditwilds.async",
+                                       username=bot_username, password=bot_password)
+        self.toxicity_queue = asyncio.Queue(maxsize=self.toxicity_queue_size)
+        metrics.set_gauge("queue_depth", self.toxicity_queue.qsize, queue="toxicity",
+                          subreddits="+".join(self.toxicity_subreddits))
+        # the tasks are restarted on their own, these are only closed once the whole pipeline stops
+        try:
+            async with aiohttp.ClientSession() as self.session:
+                tasks = [self.supervise("ModActions", self.handle_mod_actions)]
+                if self.flush_sheets:
+                    tasks.append(self.supervise("SheetsFlush",
+                                                lambda: self.recorder.flush_forever_async(self.session)))
+                if self.toxicity_subreddits:
+                    tasks.append(self.supervise("Comment", self.handle_comments))
+                    tasks += [self.supervise(f"ToxicityScorer-{i}", self.score_forever)
+                              for i in range(self.toxicity_workers)]
+                print(f"Started async pipeline with {len(tasks)} tasks")
+                await asyncio.gather(*tasks)
+        finally:
+            await self.reddit.close()
+
+    async def supervise(self, name, coroutine_function):
+        # the ResilientThread restart policy for a coroutine
+        failures = 0
+        while True:
+            started = time.monotonic()
+            try:
+                await coroutine_function()
+                # only the sheets flush returns, once the recorder is closed
+                return
+            except Exception as e:
+                message = f"Exception in async task {name}: {e}\n```{traceback.format_exc()}```"
+                self.discord_client.send_error_msg(message)
+                print(message)
+            failures = ResilientThread.next_failures(failures, started)
+            backoff_secs = ResilientThread.backoff_secs(failures)
+            print(f"Restarting async task {name} in {backoff_secs:.1f} seconds")
+            await asyncio.sleep(backoff_secs)
+
+    async def handle_mod_actions(self):
+        subreddits = "+".join(list(self.subreddit_trackers.keys()))
+        startup_utc = time.time()
+        subreddit = await self.reddit.subreddit(subreddits)
+        poller = await self.create_poller(f"modlog:{subreddits.lower()}", subreddit.mod.log, "id")
+        async for actions in poller.pages():
+            actions = new_mod_actions(self.checkpoint_store, self.content_cache, actions, startup_utc)
+            # handlers use the content with the sync client, so it's prefetched with that client too
+            await asyncio.to_thread(prefetch_targets, self.content_cache)
+            futures = [future for action in actions for future in self.handler_registry.dispatch(action)]
+            # only checkpoint once every handler has finished with the page
+            await asyncio.wait_for(asyncio.gather(*[asyncio.wrap_future(future) for future in futures],
+                                                  return_exceptions=True), self.stall_timeout_secs)
+            await asyncio.to_thread(mark_mod_actions_processed, self.checkpoint_store, actions)
+
+    async def handle_comments(self):
+        startup_utc = time.time()
+        subreddit_name = "+".join(self.toxicity_subreddits)
+        subreddit = await self.reddit.subreddit(subreddit_name)
+        poller = await self.create_poller(f"comments:{subreddit_name.lower()}", subreddit.comments, "fullname")
+        async for comments in poller.pages():
+            comments = new_comments(self.checkpoint_store, comments, startup_utc)
+            if not comments:
+                continue
+            await self.resolve_authors(comments)
+            for comment in comments:
+                # authors are cached by now, so this only blocks for ledger writes and the rare fallback lookup
+                await asyncio.wait_for(asyncio.to_thread(handle_comment, self.discord_client, self.reddit_handler,
+                                                         comment, self.subreddit_trackers, self.author_status_cache,
+                                                         self.shadowban_ledger), self.stall_timeout_secs)
+                self.submit_toxicity(comment)
+                await asyncio.to_thread(mark_comment_processed, self.checkpoint_store, comment)
+
+    async def create_poller(self, cursor_stream, listing, cursor_attribute):
+        cursor = await asyncio.to_thread(self.checkpoint_store.get_cursor, cursor_stream)
+        return AsyncListingPoller(self.reddit, listing, cursor_attribute, cursor=cursor,
+                                  on_cursor=lambda cursor: self.checkpoint_store.set_cursor(cursor_stream, cursor),
+                                  budget_share=self.budget_share, poll_timeout_secs=self.stall_timeout_secs)
+
+    async def resolve_authors(self, comments):
+        misses = self.author_status_cache.misses(comments)
+        for batch in self.author_status_cache.batches(misses):
+            try:
+                with metrics.timed("reddit"):
+                    users = await asyncio.wait_for(self.reddit.get("/api/user_data_by_account_ids",
+                                                                   params={"ids": ",".join(batch)}),
+                                                   self.stall_timeout_secs)
+            except Exception as e:
+                print(f"Failed bulk author lookup of {len(batch)} authors: {e}")
+                continue
+            self.author_status_cache.put_users(misses, batch, users)
+
+    def submit_toxicity(self, comment):
+        # the loop can't block, so BLOCK behaves as DROP_NEWEST here
+        while True:
+            try:
+                self.toxicity_queue.put_nowait(comment)
+                return
+            except asyncio.QueueFull:
+                if self.toxicity_drop_policy != ToxicityScorer.DROP_OLDEST:
+                    self.record_drop(comment)
+                    return
+            try:
+                self.record_drop(self.toxicity_queue.get_nowait())
+                self.toxicity_queue.task_done()
+            except asyncio.QueueEmpty:
+                pass
+
+    def record_drop(self, comment):
+        metrics.inc("dropped_total", queue="toxicity")
+        print(f"Toxicity queue full, dropped comment {comment.id}")
+
+    async def score_forever(self):
+        while True:
+            comment = await self.toxicity_queue.get()
+            try:
+                if self.toxicity_prefilter and self.toxicity_prefilter.is_benign(comment.body):
+                    continue
+                result = await self.determine_toxicity(comment.body)
+                report_if_toxic(self.reddit_handler, comment, result)
+            except Exception as e:
+                message = f"Exception when handling toxic comment {comment.id}: {e}\n```{traceback.format_exc()}```"
+                self.discord_client.send_error_msg(message)
+                print(message)
+            finally:
+                self.toxicity_queue.task_done()
+
+    async def determine_toxicity(self, text):
+        # moderation.determine_toxicity with aiohttp, errors from the API also score 0
+        text = toxicity_text(text)
+        if text is None:
+            return 0
+
+        cached_score = cached_toxicity(self.toxicity_cache, text)
+        if cached_score is not None:
+            return cached_score
+
+        start_time = time.monotonic()
+        timeout = aiohttp.ClientTimeout(total=moderation.TOXICITY_API_TIMEOUT_SECS)
+        try:
+            with metrics.timed("toxicity"):
+                async with self.session.post(moderation.TOXICITY_API_URL,
+                                             json={"token": self.toxicity_api_key, "text": text},
+                                             timeout=timeout) as response:
+                    response = await response.json(content_type=None)
+            score = toxicity_score(response)
+        except Exception:
+            return 0
+        # the cache is periodically saved to disk as it's updated
+        await asyncio.to_thread(cache_toxicity, self.toxicity_cache, text, score, time.monotonic() - start_time)
+        return score
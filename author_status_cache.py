@@ -0,0 +1,113 @@
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import metrics
+
+
+class AuthorStatusCache:
+    OK = "ok"
+    SUSPENDED = "suspended"
+    SHADOWBANNED = "shadowbanned"
+    # regulars are re-checked daily, banned accounts more often so reinstated users are noticed quickly
+    TTL_SECS = {
+        OK: 24 * 60 * 60,
+        SUSPENDED: 60 * 60,
+        SHADOWBANNED: 60 * 60,
+    }
+    # /api/user_data_by_account_ids accepts up to 100 account fullnames per request
+    MAX_BATCH_SIZE = 100
+    MAX_SIZE = 50000
+
+    def __init__(self, reddit, ttl_secs=None, max_size=MAX_SIZE):
+        self.reddit = reddit
+        self.ttl_secs = ttl_secs if ttl_secs else self.TTL_SECS
+        self.max_size = max_size
+        # author name -> (expiry time, status), ordered least to most recently used
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def resolve(self, comments):
+        # look up every uncached author of these comments in as few requests as possible
+        misses = self.misses(comments)
+        for batch in self.batches(misses):
+            try:
+                with metrics.timed("reddit"):
+                    users = self.reddit.get("/api/user_data_by_account_ids", params={"ids": ",".join(batch)})
+            except Exception as e:
+                # leave these uncached, get_status falls back to looking each author up individually
+                print(f"Failed bulk author lookup of {len(batch)} authors: {e}")
+                continue
+            self.put_users(misses, batch, users)
+
+    def misses(self, comments):
+        # author fullname -> name, for every author of these comments who isn't cached
+        misses = dict()
+        with self.lock:
+            for comment in comments:
+                author_fullname = comment.author_fullname
+                name = self.author_name(comment)
+                if author_fullname and name and self._get_cached(name) is None:
+                    misses[author_fullname] = name
+        return misses
+
+    def batches(self, misses):
+        fullnames = list(misses.keys())
+        return [fullnames[i:i + self.MAX_BATCH_SIZE] for i in range(0, len(fullnames), self.MAX_BATCH_SIZE)]
+
+    def put_users(self, misses, batch, users):
+        for author_fullname in batch:
+            self.put(misses[author_fullname], self.status_from_user_data(users.get(author_fullname)))
+
+    def get_status(self, comment):
+        name = self.author_name(comment)
+        if not name or not comment.author_fullname:
+            # deleted and shadowbanned authors don't have account details on their comments
+            return self.SHADOWBANNED
+        with self.lock:
+            status = self._get_cached(name)
+        if status is None:
+            status = self.fetch_status(self.reddit.redditor(name))
+            self.put(name, status)
+        return status
+
+    @staticmethod
+    def author_name(comment):
+        return comment.author
+
+    def status_from_user_data(self, user_data):
+        # shadowbanned accounts are omitted from the response entirely
+        if user_data is None:
+            return self.SHADOWBANNED
+        if user_data.get('is_suspended') or 'created_utc' not in user_data:
+            return self.SUSPENDED
+        return self.OK
+
+    def fetch_status(self, author):
+        try:
+            if not hasattr(author, 'created'):
+                return self.SHADOWBANNED
+            if hasattr(author, 'is_suspended') and author.is_suspended:
+                return self.SUSPENDED
+            return self.OK
+        except Exception as e:
+            # Sometimes they also just return 404s so this handles that too
+            return self.SHADOWBANNED
+
+    def put(self, name, status):
+        with self.lock:
+            self.cache[name] = (time.monotonic() + self.ttl_secs[status], status)
+            self.cache.move_to_end(name)
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+
+    def _get_cached(self, name):
+        entry = self.cache.get(name)
+        if entry is None:
+            return None
+        expiry, status = entry
+        if expiry < time.monotonic():
+            del self.cache[name]
+            return None
+        self.cache.move_to_end(name)
+        return status
@@ -0,0 +1,148 @@
+import argparse
+import os
+from datetime import datetime, timezone
+
+import bot
+import config
+import moderation
+from checkpoint_store import CheckpointStore
+from content_cache import ContentCache
+from mod_action_store import ModActionStore
+from records import ModActionRecord
+from google_sheets_recorder import GoogleSheetsRecorder
+from settings import SettingsFactory
+
+# sheets serial date of 1970-01-01
+SHEETS_EPOCH_SERIAL = 25569
+BATCH_ROWS = 1000
+DONE_CURSOR = "done"
+
+
+class ConsoleErrorReporter:
+    # stands in for the discord client, backfills are run by hand so errors only need printing
+    def send_error_msg(self, message):
+        print(message)
+
+
+class RowCollector:
+    # collects the rows handle_mod_action records, so they can be written in large batches
+    def __init__(self):
+        self.rows = list()
+
+    def append_to_sheet(self, subreddit_name, created_utc, mod_name, action, link, details):
+        self.rows.append(GoogleSheetsRecorder.format_row(created_utc, mod_name, action, link, details))
+
+
+def row_key(row):
+    # identifies an action regardless of how sheets rendered its timestamp
+    if len(row) < 3:
+        return None
+    timestamp = row[0]
+    if isinstance(timestamp, (int, float)):
+        created_utc = round((timestamp - SHEETS_EPOCH_SERIAL) * 86400)
+    else:
+        try:
+            created_utc = round(datetime.fromisoformat(str(timestamp)).replace(tzinfo=timezone.utc).timestamp())
+        except ValueError:
+            return None
+    link = row[3] if len(row) > 3 else ''
+    return created_utc, str(row[1]), str(row[2]), str(link)
+
+
+def parse_date(value):
+    return datetime.fromisoformat(value).replace(tzinfo=timezone.utc).timestamp()
+
+
+def new_rows(rows, existing_keys):
+    # rows already in the sheet are skipped, e.g. those written by an interrupted run
+    kept = list()
+    for row in rows:
+        key = row_key(row)
+        if key in existing_keys:
+            continue
+        existing_keys.add(key)
+        kept.append(row)
+    return kept
+
+
+def backfill(subreddit_name, start_utc, end_utc, batch_rows):
+    settings = SettingsFactory.get_settings(subreddit_name)
+    if not settings.google_sheet_id or not settings.google_sheet_name:
+        raise ValueError(f"{subreddit_name} has no google sheet configured")
+    sheet_id = settings.google_sheet_id
+    sheet_name = settings.google_sheet_name
+
+    reddit = bot.create_reddit(os.environ.get("BOT_PASSWORD", config.BOT_PASSWORD),
+                               os.environ.get("BOT_USERNAME", config.BOT_USERNAME),
+                               os.environ.get("CLIENT_ID", config.CLIENT_ID),
+                               os.environ.get("CLIENT_SECRET", config.CLIENT_SECRET), "backfill")
+    recorder = GoogleSheetsRecorder(ConsoleErrorReporter())
+    checkpoint_store = CheckpointStore(os.environ.get("STATE_DB_PATH", config.STATE_DB_PATH))
+    # the local store is filled too, so !modstats covers the backfilled range
+    mod_action_store = ModActionStore(os.environ.get("MOD_ACTION_DB_PATH", config.MOD_ACTION_DB_PATH),
+                                      int(os.environ.get("MOD_ACTION_RETENTION_DAYS",
+                                                         config.MOD_ACTION_RETENTION_DAYS)),
+                                      int(os.environ.get("MOD_ACTION_MAX_ROWS", config.MOD_ACTION_MAX_ROWS)))
+    content_cache = ContentCache(reddit)
+    subreddit = reddit.subreddit(subreddit_name)
+    excluded_mods = {mod.lower() for mod in bot.RECORD_EXCLUDED_MODS}
+
+    # only a finished range is recorded. an interrupted run only ever wrote the oldest rows of the range, a rerun
+    # reads the whole range again and appends the rows after them
+    stream = f"backfill:{subreddit_name.lower()}:{int(start_utc)}:{int(end_utc)}"
+    if checkpoint_store.get_cursor(stream) == DONE_CURSOR:
+        print(f"Backfill of {subreddit_name} for this date range has already finished")
+        return
+    print(f"Backfilling {subreddit_name} into {sheet_name}")
+
+    existing_keys = {key for key in map(row_key, recorder.read_rows(sheet_id, sheet_name)) if key}
+    print(f"Found {len(existing_keys)} rows already in {sheet_name}")
+
+    # the log pages newest first, sheets lists it oldest first. the whole range is read before anything is appended
+    # so rows stay in order across batches
+    collector = RowCollector()
+    cursor = None
+    done = False
+    while not done:
+        params = {"after": cursor} if cursor else {}
+        page = list(subreddit.mod.log(limit=100, params=params))
+        if page:
+            actions = [ModActionRecord.from_praw(action) for action in page
+                       if start_utc <= action.created_utc < end_utc and str(action.mod).lower() not in excluded_mods]
+            content_cache.queue([action.target_fullname for action in actions
+                                 if action.action in moderation.CONTENT_ACTIONS])
+            content_cache.fetch_pending()
+            for action in actions:
+                bot.handle_mod_action(collector, content_cache, action, mod_action_store)
+            cursor = page[-1].id
+        done = not page or page[-1].created_utc < start_utc
+        if page:
+            print(f"Read {len(collector.rows)} rows, reached {datetime.utcfromtimestamp(page[-1].created_utc)}")
+
+    rows = new_rows(reversed(collector.rows), existing_keys)
+    collector.rows = list()
+    for start in range(0, len(rows), batch_rows):
+        if not recorder.append_to_sheet_helper(sheet_id, sheet_name, rows[start:start + batch_rows]):
+            print(f"Stopping, rows were not written after {start} of {len(rows)}. Rerun to append the rest")
+            return
+        print(f"Wrote {min(start + batch_rows, len(rows))} of {len(rows)} rows")
+    checkpoint_store.set_cursor(stream, DONE_CURSOR)
+    print(f"Backfill of {subreddit_name} finished")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record a date range of a subreddit's historical mod log into its "
+                                                 "google sheet, oldest first. Rerun the same command to resume an "
+                                                 "interrupted backfill, rows already in the sheet are skipped")
+    parser.add_argument('subreddit')
+    parser.add_argument('start', help="UTC date to backfill from, e.g. 2023-01-31")
+    parser.add_argument('end', nargs='?', help="UTC date to backfill until (exclusive), defaults to now")
+    parser.add_argument('--batch-rows', type=int, default=BATCH_ROWS, help="rows per sheets append")
+    args = parser.parse_args()
+
+    end_utc = parse_date(args.end) if args.end else datetime.now(timezone.utc).timestamp()
+    backfill(args.subreddit, parse_date(args.start), end_utc, args.batch_rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,601 @@
+import argparse
+import gc
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import bot
+import config
+import moderation
+from content_cache import ContentCache
+from author_status_cache import AuthorStatusCache
+from metrics import metrics
+from mod_action_store import ModActionStore
+from records import CommentRecord, ModActionRecord
+from reddit_actions_handler import RedditActionsHandler
+from settings import Settings
+from shadowban_ledger import ShadowbanLedger
+from subreddit_tracker import SubredditTracker
+from toxicity_cache import ToxicityCache
+from toxicity_scorer import ToxicityScorer
+
+MOD_ACTION_FIELDS = ["id", "action", "details", "subreddit", "created_utc", "target_fullname", "target_permalink",
+                     "target_author"]
+CONTENT_FIELDS = ["fullname", "id", "score", "title", "permalink", "mod_reports_dismissed"]
+
+
+class StopReplay(Exception):
+    pass
+
+
+class Dependencies:
+    # counts calls to each fake dependency and applies its injected latency
+    def __init__(self, latencies):
+        self.latencies = latencies
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def call(self, name):
+        with self.lock:
+            self.calls[name] += 1
+        latency = self.latencies.get(name.split(".")[0], 0)
+        if latency:
+            time.sleep(latency)
+
+
+class FakeRedditor:
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+    def __eq__(self, other):
+        # like praw, redditors compare equal to their name
+        if isinstance(other, str):
+            return other.lower() == self.name.lower()
+        return isinstance(other, FakeRedditor) and other.name.lower() == self.name.lower()
+
+    def __hash__(self):
+        return hash(self.name.lower())
+
+
+class FakeModerator(FakeRedditor):
+    def __init__(self, name, mod_permissions):
+        super().__init__(name)
+        self.mod_permissions = mod_permissions
+
+
+class FakeThing:
+    def __init__(self, dependencies, fields):
+        self.dependencies = dependencies
+        for key, value in fields.items():
+            setattr(self, key, value)
+
+    def __str__(self):
+        return getattr(self, 'id', '')
+
+
+class FakeModAction(FakeThing):
+    def __init__(self, dependencies, fields):
+        super().__init__(dependencies, {key: value for key, value in fields.items() if key != 'mod'})
+        self.mod = FakeRedditor(fields['mod'])
+
+
+class FakeCommentMod:
+    def __init__(self, dependencies):
+        self.dependencies = dependencies
+
+    def distinguish(self, sticky=False):
+        self.dependencies.call("reddit.distinguish")
+
+    def lock(self):
+        self.dependencies.call("reddit.lock")
+
+    def remove(self, mod_note=None):
+        self.dependencies.call("reddit.remove")
+
+
+class FakeComment(FakeThing):
+    def __init__(self, dependencies, fields):
+        super().__init__(dependencies, {key: value for key, value in fields.items()
+                                        if key not in ['author', 'subreddit']})
+        self.author = FakeRedditor(fields['author']) if fields.get('author') else None
+        self.subreddit = FakeSubreddit(dependencies, fields['subreddit'], None)
+        self.subreddit_name_prefixed = f"r/{fields['subreddit']}"
+        self.fullname = f"t1_{fields['id']}"
+        self.mod = FakeCommentMod(dependencies)
+
+    def report(self, reason):
+        self.dependencies.call("reddit.report")
+
+    def reply(self, body):
+        self.dependencies.call("reddit.reply")
+        return FakeComment(self.dependencies, {'id': 'reply', 'subreddit': self.subreddit.display_name})
+
+
+class FakeSubredditMod:
+    def __init__(self, subreddit):
+        self.subreddit = subreddit
+
+    def log(self, limit=100, params=None):
+        return self.subreddit.replay.mod_log_listing(limit, params)
+
+
+class FakeSubreddit:
+    def __init__(self, dependencies, display_name, replay):
+        self.dependencies = dependencies
+        self.display_name = display_name
+        self.replay = replay
+        self.mod = FakeSubredditMod(self)
+
+    def __str__(self):
+        return self.display_name
+
+    def moderator(self):
+        self.dependencies.call("reddit.moderator")
+        moderators = self.replay.fixtures['subreddits'].get(self.display_name.lower(), {}).get('moderators', [])
+        return [FakeModerator(moderator['name'], moderator['mod_permissions']) for moderator in moderators]
+
+    def comments(self, limit=100, params=None):
+        return self.replay.comment_listing(limit, params)
+
+    def new(self, limit=None):
+        self.dependencies.call("reddit.new")
+        return iter([])
+
+    def submit(self, title, url=None, send_replies=True):
+        self.dependencies.call("reddit.submit")
+
+
+class FakeAuth:
+    def __init__(self):
+        self.limits = {'remaining': 1000000, 'reset_timestamp': time.time() + 600, 'used': 0}
+
+
+class FakeReddit:
+    def __init__(self, dependencies, replay):
+        self.dependencies = dependencies
+        self.replay = replay
+        self.auth = FakeAuth()
+
+    def subreddit(self, display_name):
+        return FakeSubreddit(self.dependencies, display_name, self.replay)
+
+    def comment(self, id=None):
+        # like praw, a lazy comment which can be acted on without fetching it
+        return FakeComment(self.dependencies, {'id': id, 'subreddit': 'benchmark'})
+
+    def redditor(self, name=None):
+        return FakeRedditor(name)
+
+    def info(self, fullnames=None):
+        self.dependencies.call("reddit.info")
+        contents = self.replay.fixtures['contents']
+        return [FakeThing(self.dependencies, contents[fullname]) for fullname in fullnames if fullname in contents]
+
+    def submission(self, id=None):
+        self.dependencies.call("reddit.submission")
+        fullname = f"t3_{id}"
+        return FakeThing(self.dependencies, self.replay.fixtures['contents'].get(fullname, {'id': id}))
+
+    def get(self, path, params=None):
+        self.dependencies.call("reddit.get")
+        users = self.replay.fixtures['users']
+        return {fullname: users[fullname] for fullname in params['ids'].split(",") if fullname in users}
+
+
+class QueuedFake:
+    # the real discord client and sheets recorder only queue work for a single sender,
+    # so their injected latency is paid on a background thread rather than by the caller
+    def __init__(self, dependencies):
+        self.dependencies = dependencies
+        self.executor = ThreadPoolExecutor(1)
+
+    def queue_call(self, name):
+        self.executor.submit(self.dependencies.call, name)
+
+    def wait_for_all(self):
+        self.executor.shutdown(wait=True)
+
+
+class FakeDiscordClient(QueuedFake):
+    def send_msg(self, guild_name, channel_name, message):
+        self.queue_call("discord.send_msg")
+
+    def send_error_msg(self, message):
+        self.queue_call("discord.send_error_msg")
+        print(message)
+
+
+class FakeGoogleSheetsRecorder(QueuedFake):
+    def append_to_sheet(self, subreddit_name, created_utc, mod_name, action, link, details):
+        self.queue_call("sheets.append_to_sheet")
+
+
+class FakeCheckpointStore:
+    # everything replayed is new, and the replay ends once every item has been processed
+    def __init__(self, expected_items):
+        self.expected_items = expected_items
+        self.processed_items = 0
+
+    def is_new(self, stream, created_utc, item_id, default_created_utc):
+        return True
+
+    def mark_processed(self, stream, created_utc, item_id):
+        self.processed_items += 1
+        if self.processed_items >= self.expected_items:
+            raise StopReplay()
+
+    def get_cursor(self, stream):
+        return "replay-start"
+
+    def set_cursor(self, stream, cursor):
+        pass
+
+
+class BenchmarkRedditActionsHandler(RedditActionsHandler):
+    # only the injected latency of the fake reddit paces outbound actions
+    MIN_CALL_GAP_SECS = 0
+
+    def __init__(self, discord_client, reddit):
+        super().__init__(discord_client, reddit)
+        self.futures = list()
+
+    def schedule(self, priority, description, payload, spill=True):
+        future = super().schedule(priority, description, payload, spill)
+        self.futures.append(future)
+        return future
+
+    def wait_for_all(self):
+        for future in list(self.futures):
+            future.exception()
+
+
+class FakeToxicityServer:
+    # stands in for the moderatehatespeech endpoint, scoring from the recorded fixtures
+    def __init__(self, dependencies, scores):
+        class ToxicityRequestHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                dependencies.call("toxicity.moderate")
+                score = scores.get(text_hash(body['text']), 0)
+                response = json.dumps({'class': 'flag' if score else 'normal', 'confidence': score}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), ToxicityRequestHandler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+        threading.Thread(target=self.server.serve_forever, name="FakeToxicity", daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+
+
+class Replay:
+    def __init__(self, fixtures, latencies):
+        self.fixtures = fixtures
+        self.dependencies = Dependencies(latencies)
+        self.actions = [FakeModAction(self.dependencies, action) for action in fixtures['mod_actions']]
+        self.comments = [FakeComment(self.dependencies, comment) for comment in fixtures['comments']]
+
+    def mod_log_listing(self, limit, params):
+        self.dependencies.call("reddit.mod_log")
+        return self.listing(self.actions, [action.id for action in self.actions], limit, params)
+
+    def comment_listing(self, limit, params):
+        self.dependencies.call("reddit.comments")
+        return self.listing(self.comments, [comment.fullname for comment in self.comments], limit, params)
+
+    @staticmethod
+    def listing(items, cursors, limit, params):
+        # like reddit, returns up to limit items newer than the "before" cursor, newest first
+        before = (params or {}).get('before')
+        start = 0 if before == "replay-start" else cursors.index(before) + 1 if before in cursors \
+            else len(cursors) - limit
+        page = items[max(start, 0):max(start, 0) + limit]
+        return list(reversed(page))
+
+    def create_trackers(self, reddit):
+        subreddit_trackers = dict()
+        for subreddit_name in self.fixtures['subreddits'].keys():
+            settings = Settings()
+            subreddit = reddit.subreddit(subreddit_name)
+            subreddit_trackers[subreddit_name.lower()] = SubredditTracker(
+                reddit, subreddit, reddit.subreddit(f"{subreddit_name}_wilds"),
+                reddit.subreddit(f"{subreddit_name}removals"), settings.comment_mod_permissions,
+                settings.comment_mod_whitelist, "Benchmark", "removals", "bans", "shadowbans", True)
+        return subreddit_trackers
+
+    def calls_since(self, before):
+        return {name: count - before.get(name, 0) for name, count in self.dependencies.calls.items()
+                if count - before.get(name, 0)}
+
+    def run_mod_actions(self):
+        reddit = FakeReddit(self.dependencies, self)
+        discord_client = FakeDiscordClient(self.dependencies)
+        recorder = FakeGoogleSheetsRecorder(self.dependencies)
+        reddit_handler = BenchmarkRedditActionsHandler(discord_client, reddit)
+        subreddit_trackers = self.create_trackers(reddit)
+        content_cache = ContentCache(reddit)
+        # the real store, in memory, so its write cost is part of the record handler's time
+        mod_action_store = ModActionStore(":memory:")
+        handler_registry = bot.create_handler_registry(discord_client, recorder, reddit_handler, subreddit_trackers,
+                                                       content_cache, mod_action_store)
+        checkpoint_store = FakeCheckpointStore(len(self.actions))
+        calls_before = Counter(self.dependencies.calls)
+
+        start_time = time.monotonic()
+        try:
+            bot.handle_mod_actions(reddit, subreddit_trackers, content_cache, checkpoint_store, handler_registry)
+        except StopReplay:
+            pass
+        ingest_secs = time.monotonic() - start_time
+        reddit_handler.wait_for_all()
+        recorder.wait_for_all()
+        discord_client.wait_for_all()
+        drain_secs = time.monotonic() - start_time
+        return ingest_secs, drain_secs, self.calls_since(calls_before)
+
+    def run_comments(self, toxicity_workers, use_toxicity_cache):
+        reddit = FakeReddit(self.dependencies, self)
+        discord_client = FakeDiscordClient(self.dependencies)
+        reddit_handler = BenchmarkRedditActionsHandler(discord_client, reddit)
+        subreddit_trackers = self.create_trackers(reddit)
+        subreddit = reddit.subreddit("+".join(subreddit_trackers.keys()))
+        author_status_cache = AuthorStatusCache(reddit)
+        toxicity_cache = ToxicityCache() if use_toxicity_cache else None
+        toxicity_server = FakeToxicityServer(self.dependencies, self.fixtures['toxicity'])
+        moderation.TOXICITY_API_URL = toxicity_server.url
+        toxicity_scorer = ToxicityScorer(discord_client,
+                                         lambda comment: moderation.handle_toxic_comments(
+                                             discord_client, reddit_handler, "benchmark", toxicity_cache, None,
+                                             comment),
+                                         num_workers=toxicity_workers,
+                                         max_queue_size=len(self.fixtures['comments']) + 1)
+        checkpoint_store = FakeCheckpointStore(len(self.comments))
+        # in memory, and never rolled up during a replay
+        shadowban_ledger = ShadowbanLedger(discord_client, ":memory:", lambda rollups: None)
+        calls_before = Counter(self.dependencies.calls)
+
+        start_time = time.monotonic()
+        try:
+            bot.handle_comments(discord_client, reddit, subreddit, reddit_handler, toxicity_scorer,
+                                subreddit_trackers, author_status_cache, checkpoint_store, shadowban_ledger)
+        except StopReplay:
+            pass
+        ingest_secs = time.monotonic() - start_time
+        toxicity_scorer.queue.join()
+        reddit_handler.wait_for_all()
+        discord_client.wait_for_all()
+        drain_secs = time.monotonic() - start_time
+        toxicity_server.close()
+        return ingest_secs, drain_secs, self.calls_since(calls_before)
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def print_results(name, event_count, ingest_secs, drain_secs, calls):
+    print(f"\n{name}: {event_count} events")
+    print(f"  ingest: {ingest_secs:.3f}s ({event_count / max(ingest_secs, 1e-9):.1f} events/sec)")
+    print(f"  until all outbound work finished: {drain_secs:.3f}s "
+          f"({event_count / max(drain_secs, 1e-9):.1f} events/sec)")
+    print("  outbound calls per event:")
+    for call_name, count in sorted(calls.items()):
+        print(f"    {call_name}: {count / max(event_count, 1):.3f} ({count} total)")
+
+
+def print_handler_times():
+    print("\nPer-handler time:")
+    with metrics.lock:
+        histograms = [(labels, histogram) for (name, labels), histogram in metrics.histograms.items()
+                      if name == "handler_seconds"]
+    for labels, histogram in sorted(histograms):
+        handler = dict(labels)['handler']
+        print(f"  {handler}: n={histogram.count}, total={histogram.sum:.3f}s, "
+              f"avg={histogram.sum / max(histogram.count, 1) * 1000:.2f}ms")
+
+
+def queued_bytes_per_event(build, items):
+    # memory still held once every item has been built, as if they were all waiting in a queue. each item is
+    # parsed from its own json like a reddit response, so its field values are counted too
+    items = [json.dumps(item) for item in items]
+    gc.collect()
+    tracemalloc.start()
+    queued = [build(json.loads(item)) for item in items]
+    held_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return held_bytes / max(len(queued), 1)
+
+
+def source_builders(dependencies):
+    # real praw objects built from the fixture fields without any network access, or the fakes if praw isn't usable
+    try:
+        import praw
+        from praw.models import Comment, ModAction
+        reddit = praw.Reddit(client_id="benchmark", client_secret="benchmark", user_agent="benchmark",
+                             check_for_updates=False)
+        return ("praw objects",
+                lambda fields: ModAction(reddit, _data=dict(fields)),
+                lambda fields: Comment(reddit, _data=dict(fields, author=fields.get('author') or "[deleted]")))
+    except Exception as e:
+        print(f"Measuring memory against the fakes, unable to build praw objects: {e}")
+        return ("fakes",
+                lambda fields: FakeModAction(dependencies, fields),
+                lambda fields: FakeComment(dependencies, fields))
+
+
+def print_memory(fixtures):
+    source_name, build_action, build_comment = source_builders(Dependencies({}))
+    print(f"\nMemory per queued event, {source_name} vs records:")
+    for name, items, build, record_type in [("mod actions", fixtures['mod_actions'], build_action, ModActionRecord),
+                                            ("comments", fixtures['comments'], build_comment, CommentRecord)]:
+        if not items:
+            continue
+        source_bytes = queued_bytes_per_event(build, items)
+        record_bytes = queued_bytes_per_event(lambda fields: record_type.from_praw(build(fields)), items)
+        print(f"  {name}: {source_bytes:.0f} bytes vs {record_bytes:.0f} bytes")
+
+
+def replay(args):
+    with open(args.fixtures) as f:
+        fixtures = json.load(f)
+    latencies = {'reddit': args.reddit_latency, 'sheets': args.sheets_latency, 'discord': args.discord_latency,
+                 'toxicity': args.toxicity_latency}
+    Settings.is_dry_run = False
+    replay_run = Replay(fixtures, latencies)
+    if fixtures['mod_actions']:
+        print_results("Mod actions", len(fixtures['mod_actions']), *replay_run.run_mod_actions())
+        print_handler_times()
+    if fixtures['comments']:
+        print_results("Comments", len(fixtures['comments']),
+                      *replay_run.run_comments(args.toxicity_workers, args.toxicity_cache))
+    print_memory(fixtures)
+
+
+def record(args):
+    # records real mod log actions and comments, with everything the handlers look up about them
+    reddit = bot.create_reddit(os.environ.get("BOT_PASSWORD", config.BOT_PASSWORD),
+                               os.environ.get("BOT_USERNAME", config.BOT_USERNAME),
+                               os.environ.get("CLIENT_ID", config.CLIENT_ID),
+                               os.environ.get("CLIENT_SECRET", config.CLIENT_SECRET), "benchmark")
+    toxicity_api_key = os.environ.get("TOXICITY_API_KEY", config.TOXICITY_API_KEY)
+    subreddit_names = [name.strip() for name in args.subreddits.split(",")]
+    subreddit = reddit.subreddit("+".join(subreddit_names))
+    fixtures = {'subreddits': dict(), 'mod_actions': list(), 'contents': dict(), 'comments': list(), 'users': dict(),
+                'toxicity': dict()}
+
+    for subreddit_name in subreddit_names:
+        moderators = [{'name': moderator.name, 'mod_permissions': moderator.mod_permissions}
+                      for moderator in reddit.subreddit(subreddit_name).moderator()]
+        fixtures['subreddits'][subreddit_name.lower()] = {'moderators': moderators}
+
+    for action in reversed(list(subreddit.mod.log(limit=args.actions))):
+        fields = {field: getattr(action, field, None) for field in MOD_ACTION_FIELDS}
+        fields['mod'] = action.mod.name
+        fixtures['mod_actions'].append(fields)
+    fullnames = list({action['target_fullname'] for action in fixtures['mod_actions']
+                      if action['action'] in moderation.CONTENT_ACTIONS})
+    for i in range(0, len(fullnames), 100):
+        for content in reddit.info(fullnames=fullnames[i:i + 100]):
+            fixtures['contents'][content.fullname] = {field: getattr(content, field, None)
+                                                      for field in CONTENT_FIELDS}
+
+    for comment in reversed(list(subreddit.comments(limit=args.comments))):
+        fixtures['comments'].append({'id': comment.id, 'body': comment.body, 'permalink': comment.permalink,
+                                     'subreddit': comment.subreddit.display_name,
+                                     'created_utc': comment.created_utc,
+                                     'author': comment.author.name if comment.author else None,
+                                     'author_fullname': getattr(comment, 'author_fullname', None)})
+        if args.score_toxicity:
+            score = moderation.determine_toxicity(comment.body, toxicity_api_key)
+            if score:
+                fixtures['toxicity'][text_hash(comment.body)] = score
+    author_fullnames = list({comment['author_fullname'] for comment in fixtures['comments']
+                             if comment['author_fullname']})
+    for i in range(0, len(author_fullnames), 100):
+        fixtures['users'].update(reddit.get("/api/user_data_by_account_ids",
+                                            params={"ids": ",".join(author_fullnames[i:i + 100])}))
+
+    with open(args.fixtures, 'w') as f:
+        json.dump(fixtures, f, indent=1)
+    print(f"Recorded {len(fixtures['mod_actions'])} mod actions and {len(fixtures['comments'])} comments "
+          f"to {args.fixtures}")
+
+
+def synthesize(args):
+    # fake but plausible fixtures, for benchmarking without any reddit account
+    rng = random.Random(args.seed)
+    subreddit_name = "benchmark"
+    mods = [f"mod{i}" for i in range(10)] + ["AutoModerator"]
+    comment_mods = mods[:3]
+    fixtures = {'subreddits': {subreddit_name: {'moderators': [
+        {'name': mod, 'mod_permissions': Settings.comment_mod_permissions if mod in comment_mods else ['all']}
+        for mod in mods]}}, 'mod_actions': list(), 'contents': dict(), 'comments': list(), 'users': dict(),
+        'toxicity': dict()}
+    now = time.time()
+    action_types = ["removecomment"] * 6 + ["approvecomment"] * 2 + ["removelink", "approvelink", "banuser",
+                                                                     "editflair"]
+    for i in range(args.actions):
+        action_type = rng.choice(action_types)
+        kind = "t3" if action_type.endswith("link") else "t1"
+        target_fullname = f"{kind}_{rng.randrange(args.actions):x}"
+        fixtures['mod_actions'].append({
+            'id': f"ModAction_{i:08x}", 'action': action_type, 'mod': rng.choice(mods), 'details': 'rule',
+            'subreddit': subreddit_name, 'created_utc': now - args.actions + i,
+            'target_fullname': target_fullname, 'target_permalink': f"/r/{subreddit_name}/comments/{i:x}/",
+            'target_author': f"user{rng.randrange(1000)}"})
+        fixtures['contents'][target_fullname] = {
+            'fullname': target_fullname, 'id': target_fullname[3:], 'score': rng.randrange(1000),
+            'title': f"Post {i}", 'permalink': f"/r/{subreddit_name}/comments/{target_fullname[3:]}/",
+            'mod_reports_dismissed': [["rule 1", "AutoModerator"]] if rng.random() < 0.2 else []}
+    slogans = [f"copy pasted slogan {i}" for i in range(20)]
+    for i in range(args.comments):
+        author = f"user{rng.randrange(1000)}"
+        author_fullname = f"t2_{author}"
+        body = rng.choice(slogans) if rng.random() < 0.2 else f"comment number {i} " * rng.randrange(1, 20)
+        fixtures['comments'].append({'id': f"{i:x}", 'body': body, 'permalink': f"/r/{subreddit_name}/c/{i:x}/",
+                                     'subreddit': subreddit_name, 'created_utc': now - args.comments + i,
+                                     'author': author, 'author_fullname': author_fullname})
+        # a few shadowbanned authors are left out of the user data, like reddit does
+        if rng.random() > 0.01:
+            fixtures['users'][author_fullname] = {'name': author, 'created_utc': now - 1000000}
+        if rng.random() < 0.02:
+            fixtures['toxicity'][text_hash(body)] = 0.9
+    with open(args.fixtures, 'w') as f:
+        json.dump(fixtures, f)
+    print(f"Synthesized {args.actions} mod actions and {args.comments} comments to {args.fixtures}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record and replay mod log actions and comments through the "
+                                                 "moderation pipeline, with fakes standing in for every "
+                                                 "external dependency")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    record_parser = subparsers.add_parser('record', help="record real fixtures, using the bot's config")
+    record_parser.add_argument('fixtures')
+    record_parser.add_argument('--subreddits', required=True, help="comma separated subreddit names")
+    record_parser.add_argument('--actions', type=int, default=500)
+    record_parser.add_argument('--comments', type=int, default=500)
+    record_parser.add_argument('--score-toxicity', action='store_true',
+                               help="also record toxicity API scores of the comments")
+    synthesize_parser = subparsers.add_parser('synthesize', help="generate fixtures without network access")
+    synthesize_parser.add_argument('fixtures')
+    synthesize_parser.add_argument('--actions', type=int, default=2000)
+    synthesize_parser.add_argument('--comments', type=int, default=2000)
+    synthesize_parser.add_argument('--seed', type=int, default=0)
+    replay_parser = subparsers.add_parser('replay', help="replay fixtures through the pipeline")
+    replay_parser.add_argument('fixtures')
+    replay_parser.add_argument('--reddit-latency', type=float, default=0.05, help="seconds per reddit call")
+    replay_parser.add_argument('--sheets-latency', type=float, default=0)
+    replay_parser.add_argument('--discord-latency', type=float, default=0)
+    replay_parser.add_argument('--toxicity-latency', type=float, default=0.2)
+    replay_parser.add_argument('--toxicity-workers', type=int, default=config.TOXICITY_WORKERS)
+    replay_parser.add_argument('--toxicity-cache', action='store_true')
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        record(args)
+    elif args.command == 'synthesize':
+        synthesize(args)
+    else:
+        replay(args)
+
+
+if __name__ == "__main__":
+    main()
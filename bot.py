@@ -1,22 +1,44 @@
 import traceback
 import calendar
 from datetime import datetime, timedelta
+from functools import partial
 from threading import Thread
-
-import requests
+from types import SimpleNamespace
 
 import config
 import os
 import praw
 
+from author_status_cache import AuthorStatusCache
+from checkpoint_store import CheckpointStore
+from content_cache import ContentCache
 from discord_client import DiscordClient
 from google_sheets_recorder import GoogleSheetsRecorder
+from handler_registry import HandlerRegistry
+from listing_poller import ListingPoller
+from metrics import metrics
+from moderation import CONTENT_ACTIONS, handle_comment, handle_toxic_comments, mark_comment_processed, \
+    mark_mod_actions_processed, new_comments, new_mod_actions, prefetch_targets
+from mod_action_store import ModActionStore
+from outbound_journal import OutboundJournal
+from removal_debouncer import RemovalDebouncer
 from reddit_actions_handler import RedditActionsHandler
-from resilient_thread import ResilientThread
+from resilient_thread import ResilientThread, heartbeat
 from settings import *
+from shadowban_ledger import ShadowbanLedger
+from stream_groups import PROCESS_CONTEXT, DiscordRelay, StreamGroup, StreamGroupProcess
 import time
 
 from subreddit_tracker import SubredditTracker
+from thread_local_reddit import ThreadLocalReddit
+from toxicity_cache import ToxicityCache
+from toxicity_scorer import ToxicityScorer
+
+
+# mod log actions which change who the comment mods are
+MOD_TEAM_ACTIONS = ["invitemoderator", "acceptmoderatorinvite", "setpermissions", "removemoderator"]
+# bots whose actions aren't worth recording
+RECORD_EXCLUDED_MODS = ["StatementBot", "toolboxnotesxfer"]
 
 
 def get_id(fullname):
@@ -24,20 +46,13 @@ def get_id(fullname):
     return split[1] if len(split) > 0 else split[0]
 
 
-def handle_mod_removal(subreddit_tracker, discord_client, action, reddit_handler):
-    if action.action not in ["removelink", "approvelink"]:
-        return
-    # Automod exempt
-    if action.mod == "AutoModerator":
-        return
+def handle_mod_removal(subreddit_tracker, discord_client, action, reddit_handler, content_cache, collapsed_count=0):
     if action.details == "confirm_spam":
         return
-    # this is required on startup to prevent re-actioning startup stream
-    if action.created_utc < subreddit_tracker.time_last_checked:
-        return
 
-    submission_id = get_id(action.target_fullname)
-    submission = subreddit_tracker.reddit.submission(id=submission_id)
+    submission = content_cache.get(action.target_fullname)
+    if submission is None:
+        submission = subreddit_tracker.reddit.submission(id=get_id(action.target_fullname))
     title_untruc = f"[{submission.score}] {submission.title}"
     title = (title_untruc[:275] + '...') if len(title_untruc) > 275 else title_untruc
     url = f"https://np.reddit.com{submission.permalink}"
@@ -47,7 +62,7 @@ def handle_mod_removal(subreddit_tracker, discord_client, action, reddit_handler
         reddit_handler.add_post(post_removals_sub, url, title)
 
     # if post was removed by comment mod, also post to removals sub and discord if supported
-    if action.mod.name in subreddit_tracker.get_comment_mods():
+    if action.mod in subreddit_tracker.get_comment_mods():
         cm_post_actions_sub = subreddit_tracker.subreddit_removals
         if cm_post_actions_sub:
             reddit_handler.add_post(cm_post_actions_sub, url, title)
@@ -56,44 +71,44 @@ def handle_mod_removal(subreddit_tracker, discord_client, action, reddit_handler
         if cm_actions_discord and cm_actions_channel:
             detail = "removed" if action.action == "removelink" else "approved"
             message = f"A comment moderator has {detail} a post. Please follow-up with this mod.\n" \
-                      f"Comment Mod: {action.mod.name}\n" \
+                      f"Comment Mod: {action.mod}\n" \
                       f"Post: {url}\n" \
                       f"Title: {title}"
+            if collapsed_count:
+                message += f"\nThis was the final state after {collapsed_count + 1} removals and approvals"
             discord_client.send_msg(subreddit_tracker.discord_removals_server,
                                     subreddit_tracker.discord_removals_channel,
                                     message)
 
 
-def handle_mod_action(google_sheets_recorder, reddit, action):
-    if action.mod in ["StatementBot", "toolboxnotesxfer"]:
-        return
-
-    automod_report = find_automod_report(reddit, action)
+def handle_mod_action(google_sheets_recorder, content_cache, action, mod_action_store=None):
+    automod_report = find_automod_report(content_cache, action)
     if automod_report:
         # if automod reported this content, the report is the automod rule
         automod_rule = automod_report
     elif action.mod == 'AutoModerator':
         # if automod fitered this content, the action details is the automod rule
-        automod_rule = action.details if hasattr(action, 'details') else ''
+        automod_rule = action.details
     else:
         # otherwise there's no automod rule to persist
         automod_rule = ''
-    link = action.target_permalink if hasattr(action, 'target_permalink') else ''
+    link = action.target_permalink
     google_sheets_recorder.append_to_sheet(action.subreddit, action.created_utc,
-                                           action.mod.name, action.action, link, automod_rule)
+                                           action.mod, action.action, link, automod_rule)
+    if mod_action_store:
+        mod_action_store.record(action.id, action.subreddit, action.created_utc,
+                                action.mod, action.action, link, automod_rule)
 
 
-def find_automod_report(reddit, action):
-    if action.action in ["approvecomment", "removecomment"]:
-        content = reddit.comment(action.target_fullname)
-    elif action.action in ["approvelink", "removelink"]:
-        content = reddit.submission(action.target_fullname)
-    else:
-        content = None
-    if not content:
+def find_automod_report(content_cache, action):
+    if action.action not in CONTENT_ACTIONS:
         return ''
     try:
-        if hasattr(content, 'mod_reports_dismissed'):
+        content = content_cache.get(action.target_fullname)
+        if not content:
+            return ''
+        # read without fetching, the content may belong to another thread's reddit instance
+        if 'mod_reports_dismissed' in vars(content):
             reports = content.mod_reports_dismissed
             for report in reports:
                 # let's hope reports are always in [report, reporter] format?
@@ -106,100 +121,132 @@ def find_automod_report(reddit, action):
 
 
 def handle_bans(discord_client, subreddit_tracker, action):
-    if action.action not in ["banuser"]:
-        return
-
-    link_portion = f"\nURL: {action.target_permalink}" if hasattr(action, 'target_permalink') else ''
+    link_portion = f"\nURL: {action.target_permalink}" if action.target_permalink else ''
     message = f"Banned user: u/{action.target_author} for {action.details}\n" \
-              f"Moderator: {action.mod.name}{link_portion}"
+              f"Moderator: {action.mod}{link_portion}"
     discord_client.send_msg(subreddit_tracker.discord_removals_server, subreddit_tracker.discord_bans_channel, message)
 
 
-def handle_mod_actions(discord_client, google_sheets_recorder, reddit_handler, reddit, subreddit_trackers):
-    subreddits = "+".join(list(subreddit_trackers.keys()))
-    for action in reddit.subreddit(subreddits).mod.stream.log():
-        subreddit_tracker = subreddit_trackers[action.subreddit.lower()]
+def settle_removals(discord_client, subreddit_trackers, reddit_handler, content_cache, settled):
+    # settled is [(final action, number of earlier actions it replaced)], their posts are fetched together
+    content_cache.queue([action.target_fullname for action, _ in settled])
+    try:
+        content_cache.fetch_pending()
+    except Exception as e:
+        print(f"Failed to prefetch settled removal targets: {e}")
+    for action, collapsed_count in settled:
         try:
-            handle_mod_action(google_sheets_recorder, reddit, action)
-            handle_mod_removal(subreddit_tracker, discord_client, action, reddit_handler)
-            handle_bans(discord_client, subreddit_tracker, action)
+            handle_mod_removal(subreddit_trackers[action.subreddit.lower()], discord_client, action, reddit_handler,
+                               content_cache, collapsed_count)
         except Exception as e:
-            message = f"Exception when handling action {action.id} for {action.subreddit}: {e}\n" \
+            message = f"Exception when handling settled {action.action} of {action.target_fullname}: {e}\n" \
                       f"```{traceback.format_exc()}```"
             discord_client.send_error_msg(message)
             print(message)
 
 
-def handle_comments(discord_client, subreddit, reddit_handler, toxicity_api_key, subreddit_trackers):
-    for comment in subreddit.stream.comments():
+def create_handler_registry(discord_client, google_sheets_recorder, reddit_handler, subreddit_trackers,
+                            content_cache, mod_action_store=None, removal_debounce_secs=0, state_db_path=None):
+    def tracker(action):
+        return subreddit_trackers[action.subreddit.lower()]
+
+    if removal_debounce_secs:
+        # a post's removals and approvals are held for a while, so mods changing their minds only cause one
+        # crosspost or ping for its final state
+        removal_debouncer = RemovalDebouncer(discord_client, state_db_path, subreddit_trackers.keys(),
+                                             lambda settled: settle_removals(discord_client, subreddit_trackers,
+                                                                             reddit_handler, content_cache,
+                                                                             settled),
+                                             removal_debounce_secs)
+        handle_removal = removal_debouncer.submit
+    else:
+        def handle_removal(action):
+            handle_mod_removal(tracker(action), discord_client, action, reddit_handler, content_cache)
+
+    handler_registry = HandlerRegistry(discord_client)
+    # serial, so rows are appended to the sheet in mod log order
+    handler_registry.register("record",
+                              lambda action: handle_mod_action(google_sheets_recorder, content_cache, action,
+                                                               mod_action_store),
+                              excluded_mods=RECORD_EXCLUDED_MODS, serial=True)
+    # Automod exempt
+    handler_registry.register("removal", handle_removal, action_types=["removelink", "approvelink"],
+                              excluded_mods=["AutoModerator"])
+    handler_registry.register("bans", lambda action: handle_bans(discord_client, tracker(action), action),
+                              action_types=["banuser"])
+    handler_registry.register("roster", lambda action: tracker(action).invalidate_comment_mods(),
+                              action_types=MOD_TEAM_ACTIONS)
+    return handler_registry
+
+
+def handle_mod_actions(reddit, subreddit_trackers, content_cache, checkpoint_store, handler_registry,
+                       budget_share=ListingPoller.BUDGET_SHARE):
+    subreddits = "+".join(list(subreddit_trackers.keys()))
+    startup_utc = time.time()
+    # resume paging from the newest action seen, so only new actions are ever fetched
+    cursor_stream = f"modlog:{subreddits.lower()}"
+    poller = ListingPoller(reddit, reddit.subreddit(subreddits).mod.log, "id",
+                           cursor=checkpoint_store.get_cursor(cursor_stream),
+                           on_cursor=lambda cursor: checkpoint_store.set_cursor(cursor_stream, cursor),
+                           budget_share=budget_share)
+    for actions in poller.pages():
+        actions = new_mod_actions(checkpoint_store, content_cache, actions, startup_utc)
+        prefetch_targets(content_cache)
+        futures = list()
+        for action in actions:
+            # a worker abandoned as stalled part way through a page stops here, its replacement handles the rest
+            heartbeat()
+            futures += handler_registry.dispatch(action)
+        # only checkpoint once every handler has finished with the page
+        for future in futures:
+            future.exception()
+        heartbeat()
+        mark_mod_actions_processed(checkpoint_store, actions)
+
+
+def handle_comments(discord_client, reddit, subreddit, reddit_handler, toxicity_scorer, subreddit_trackers,
+                    author_status_cache, checkpoint_store, shadowban_ledger=None,
+                    budget_share=ListingPoller.BUDGET_SHARE):
+    startup_utc = time.time()
+    # resume from the newest comment handled, so restarts don't refetch and replay the latest page
+    cursor_stream = f"comments:{str(subreddit).lower()}"
+    poller = ListingPoller(reddit, subreddit.comments, "fullname",
+                           cursor=checkpoint_store.get_cursor(cursor_stream),
+                           on_cursor=lambda cursor: checkpoint_store.set_cursor(cursor_stream, cursor),
+                           budget_share=budget_share)
+    for comments in poller.pages():
+        comments = new_comments(checkpoint_store, comments, startup_utc)
+        if not comments:
+            continue
+        # look up every new author of this poll in bulk, rather than one account fetch per comment
         try:
-            handle_shadowbanned_users(discord_client, reddit_handler, comment, subreddit_trackers)
-            handle_toxic_comments(discord_client, reddit_handler, toxicity_api_key, comment)
+            author_status_cache.resolve(comments)
         except Exception as e:
-            message = f"Exception when handling comment {comment.id}: {e}\n```{traceback.format_exc()}```"
+            message = f"Exception when resolving authors of {len(comments)} comments: {e}\n" \
+                      f"```{traceback.format_exc()}```"
             discord_client.send_error_msg(message)
             print(message)
-
-
-def handle_shadowbanned_users(discord_client, reddit_handler, comment, subreddit_trackers):
-    try:
-        if ((not hasattr(comment, 'author'))
-                or (not hasattr(comment.author, 'created'))
-                or (hasattr(comment.author, 'is_suspended') and comment.author.is_suspended)):
-            respond_to_shadowban(discord_client, reddit_handler, comment, subreddit_trackers)
-    except Exception as e:
-        # Sometimes they also just return 404s so this handles that too
-        respond_to_shadowban(discord_client, reddit_handler, comment, subreddit_trackers)
-
-
-def respond_to_shadowban(discord_client, reddit_handler, comment, subreddit_trackers):
-    subreddit_tracker = subreddit_trackers[comment.subreddit.display_name.lower()]
-    discord_channel = subreddit_tracker.discord_shadowbans_channel
-    if discord_channel:
-        message = f"Shadowbanned user comment: https://www.reddit.com{comment.permalink}"
-        discord_client.send_msg(subreddit_tracker.discord_removals_server, discord_channel, message)
-    if subreddit_tracker.should_message_shadowbans:
-        message = (f"Hi, you appear to be shadow banned by reddit. "
-                   f"A shadow ban is a form of ban when reddit silently removes your content without your "
-                   f"knowledge. Only reddit admins and moderators of the community you're commenting in can see"
-                   f" the content, unless they manually approve it.\n\nThis is not a ban by "
-                   f"{comment.subreddit_name_prefixed}, and the mod team cannot help you reverse the ban. "
-                   f"We recommend visiting r/ShadowBan to confirm you're banned and how to appeal.\n\n"
-                   f"We hope knowing this can help you.\n\n"
-                   f"This is a bot - responses and messages are not monitored. "
-                   f"If it appears to be wrong, [please modmail us]"
-                   f"(https://www.reddit.com/message/compose?to=/r/collapse&subject=Shadowban Bot Error).")
-        reddit_handler.write_removal_reason_custom(comment, message)
-
-
-def handle_toxic_comments(discord_client, reddit_handler, toxicity_api_key, comment):
-    try:
-        result = determine_toxicity(comment.body, toxicity_api_key)
-        if result > 0.85:
-            percent = round(result * 100)
-            print(f'Comment ({comment.permalink}) reported @ {percent}% confidence')
-            reddit_handler.report_content(f"Automatic report for toxicity @ {percent}% confidence", comment)
-    except Exception as e:
-        message = f"Exception when handling toxic comment {comment.id}: {e}\n```{traceback.format_exc()}```"
-        discord_client.send_error_msg(message)
-        print(message)
-
-
-def determine_toxicity(text, toxicity_api_key):
-    # don't even try to error handle this, the API sends back weird stuff all the time
-    try:
-        """ Call API and return response list with boolean & confidence score """
-        text = re.sub(r'>[^\n]+', "", text)  # strip out quotes
-        if re.match(r'^\s*$', text) is not None:
-            # the comment was just quotes and/or whitespace
-            return 0
-
-        response = requests.post("https://api.moderatehatespeech.com/api/v1/moderate/",
-                                 json={"token": toxicity_api_key, "text": text}).json()
-
-        return float(response['confidence']) if response['class'] == "flag" else 0
-    except Exception as e:
-        return 0
+        for comment in comments:
+            # a worker abandoned as stalled part way through a page stops here, its replacement handles the rest
+            heartbeat()
+            handle_comment(discord_client, reddit_handler, comment, subreddit_trackers, author_status_cache,
+                           shadowban_ledger)
+            # scored on the toxicity workers so the stream never waits on the toxicity API
+            toxicity_scorer.submit(comment)
+            heartbeat()
+            mark_comment_processed(checkpoint_store, comment)
+
+
+def send_shadowban_rollups(discord_client, subreddit_trackers, rollups):
+    for subreddit_name, users in rollups.items():
+        subreddit_tracker = subreddit_trackers.get(subreddit_name)
+        if not subreddit_tracker or not subreddit_tracker.discord_shadowbans_channel:
+            continue
+        lines = [f"u/{user}: {count} more comments, latest https://www.reddit.com{permalink}"
+                 for user, count, permalink in users]
+        message = "Already notified shadowbanned users who are still commenting:\n" + "\n".join(lines)
+        discord_client.send_msg(subreddit_tracker.discord_removals_server,
+                                subreddit_tracker.discord_shadowbans_channel, message)
 
 
 def get_adjusted_utc_timestamp(time_difference_mins):
@@ -207,25 +254,43 @@ def get_adjusted_utc_timestamp(time_difference_mins):
     return calendar.timegm(adjusted_utc_dt.utctimetuple())
 
 
-def create_mod_actions_thread(discord_client, recorder, reddit_handler, reddit, subreddit_trackers):
+def create_mod_actions_thread(discord_client, recorder, reddit_handler, reddit, subreddit_trackers,
+                              checkpoint_store, mod_action_store, stall_timeout_secs,
+                              budget_share=ListingPoller.BUDGET_SHARE, removal_debounce_secs=0, state_db_path=None):
     subreddits = "+".join(list(subreddit_trackers.keys()))
     name = f"{subreddits}-ModActions"
+    content_cache = ContentCache(reddit)
+    handler_registry = create_handler_registry(discord_client, recorder, reddit_handler, subreddit_trackers,
+                                               content_cache, mod_action_store, removal_debounce_secs, state_db_path)
     thread = ResilientThread(discord_client, name, target=handle_mod_actions,
-                             args=(discord_client, recorder, reddit_handler, reddit, subreddit_trackers))
+                             args=(reddit, subreddit_trackers, content_cache, checkpoint_store, handler_registry,
+                                   budget_share),
+                             stall_timeout_secs=stall_timeout_secs)
     thread.start()
     print(f"Created {name} thread")
 
 
 def create_comment_thread(client_id, client_secret, bot_username, bot_password, discord_client, reddit_handler,
-                          subreddit_name, toxicity_api_key, subreddit_trackers):
+                          subreddit_name, toxicity_api_key, toxicity_cache, toxicity_prefilter, subreddit_trackers,
+                          toxicity_workers, toxicity_queue_size, toxicity_drop_policy, checkpoint_store,
+                          shadowban_ledger, stall_timeout_secs, budget_share=ListingPoller.BUDGET_SHARE):
     reddit = create_reddit(bot_password, bot_username, client_id, client_secret, "comment")
     subreddit = reddit.subreddit(subreddit_name)
+    author_status_cache = AuthorStatusCache(reddit)
+    toxicity_scorer = ToxicityScorer(discord_client,
+                                     lambda comment: handle_toxic_comments(discord_client, reddit_handler,
+                                                                           toxicity_api_key, toxicity_cache,
+                                                                           toxicity_prefilter, comment),
+                                     num_workers=toxicity_workers, max_queue_size=toxicity_queue_size,
+                                     drop_policy=toxicity_drop_policy, subreddits=subreddit_name)
 
     name = f"{subreddit_name}-Comment"
     thread = ResilientThread(discord_client, name,
                              target=handle_comments,
-                             args=(discord_client, subreddit, reddit_handler, toxicity_api_key,
-                                   subreddit_trackers))
+                             args=(discord_client, reddit, subreddit, reddit_handler, toxicity_scorer,
+                                   subreddit_trackers, author_status_cache, checkpoint_store, shadowban_ledger,
+                                   budget_share),
+                             stall_timeout_secs=stall_timeout_secs)
     thread.start()
     print(f"Created {name} thread")
 
@@ -241,63 +306,233 @@ def create_reddit(bot_password, bot_username, client_id, client_secret, script_t
     )
 
 
-def run_forever():
+def create_subreddit_tracker(reddit, subreddit_name):
+    settings = SettingsFactory.get_settings(subreddit_name)
+    print(f"Creating {subreddit_name} subreddit with {type(settings).__name__} settings")
+
+    subreddit_base = reddit.subreddit(subreddit_name)
+    subreddit_wilds = reddit.subreddit(settings.subreddit_wilds) if settings.subreddit_wilds else None
+    subreddit_removals = reddit.subreddit(settings.subreddit_removals) if settings.subreddit_removals else None
+    return SubredditTracker(reddit, subreddit_base, subreddit_wilds, subreddit_removals,
+                            settings.comment_mod_permissions, settings.comment_mod_whitelist,
+                            settings.discord_removals_server, settings.discord_removals_channel,
+                            settings.discord_bans_channel, settings.discord_shadowbans_channel,
+                            settings.should_message_shadowbans)
+
+
+def read_config():
     # get config from env vars if set, otherwise from config file
-    client_id = os.environ.get("CLIENT_ID", config.CLIENT_ID)
-    client_secret = os.environ.get("CLIENT_SECRET", config.CLIENT_SECRET)
-    bot_username = os.environ.get("BOT_USERNAME", config.BOT_USERNAME)
-    bot_password = os.environ.get("BOT_PASSWORD", config.BOT_PASSWORD)
-    discord_token = os.environ.get("DISCORD_TOKEN", config.DISCORD_TOKEN)
-    discord_error_guild_name = os.environ.get("DISCORD_ERROR_GUILD", config.DISCORD_ERROR_GUILD)
-    discord_error_channel_name = os.environ.get("DISCORD_ERROR_CHANNEL", config.DISCORD_ERROR_CHANNEL)
-    toxicity_api_key = os.environ.get("TOXICITY_API_KEY", config.TOXICITY_API_KEY)
     subreddits_config = os.environ.get("SUBREDDITS", config.SUBREDDITS)
-    subreddit_names = [subreddit.strip() for subreddit in subreddits_config.split(",")]
-    print("CONFIG: subreddit_names=" + str(subreddit_names))
+    return SimpleNamespace(
+        client_id=os.environ.get("CLIENT_ID", config.CLIENT_ID),
+        client_secret=os.environ.get("CLIENT_SECRET", config.CLIENT_SECRET),
+        bot_username=os.environ.get("BOT_USERNAME", config.BOT_USERNAME),
+        bot_password=os.environ.get("BOT_PASSWORD", config.BOT_PASSWORD),
+        discord_token=os.environ.get("DISCORD_TOKEN", config.DISCORD_TOKEN),
+        discord_error_guild_name=os.environ.get("DISCORD_ERROR_GUILD", config.DISCORD_ERROR_GUILD),
+        discord_error_channel_name=os.environ.get("DISCORD_ERROR_CHANNEL", config.DISCORD_ERROR_CHANNEL),
+        toxicity_api_key=os.environ.get("TOXICITY_API_KEY", config.TOXICITY_API_KEY),
+        toxicity_workers=int(os.environ.get("TOXICITY_WORKERS", config.TOXICITY_WORKERS)),
+        toxicity_queue_size=int(os.environ.get("TOXICITY_QUEUE_SIZE", config.TOXICITY_QUEUE_SIZE)),
+        toxicity_drop_policy=os.environ.get("TOXICITY_DROP_POLICY", config.TOXICITY_DROP_POLICY),
+        toxicity_cache_size=int(os.environ.get("TOXICITY_CACHE_SIZE", config.TOXICITY_CACHE_SIZE)),
+        toxicity_cache_ttl_secs=int(os.environ.get("TOXICITY_CACHE_TTL_SECS", config.TOXICITY_CACHE_TTL_SECS)),
+        toxicity_cache_path=os.environ.get("TOXICITY_CACHE_PATH", config.TOXICITY_CACHE_PATH),
+        toxicity_prefilter_path=os.environ.get("TOXICITY_PREFILTER_PATH", config.TOXICITY_PREFILTER_PATH),
+        toxicity_prefilter_threshold=float(os.environ.get("TOXICITY_PREFILTER_THRESHOLD",
+                                                          config.TOXICITY_PREFILTER_THRESHOLD)),
+        subreddit_names=[subreddit.strip() for subreddit in subreddits_config.split(",")],
+        state_db_path=os.environ.get("STATE_DB_PATH", config.STATE_DB_PATH),
+        metrics_port=int(os.environ.get("METRICS_PORT", config.METRICS_PORT)),
+        stream_stall_timeout_secs=int(os.environ.get("STREAM_STALL_TIMEOUT_SECS", config.STREAM_STALL_TIMEOUT_SECS)),
+        stream_groups=os.environ.get("STREAM_GROUPS", config.STREAM_GROUPS),
+        stream_group_processes=int(os.environ.get("STREAM_GROUP_PROCESSES", config.STREAM_GROUP_PROCESSES)),
+        shadowban_cooldown_secs=int(os.environ.get("SHADOWBAN_NOTICE_COOLDOWN_SECS",
+                                                   config.SHADOWBAN_NOTICE_COOLDOWN_SECS)),
+        shadowban_rollup_interval_secs=int(os.environ.get("SHADOWBAN_ROLLUP_INTERVAL_SECS",
+                                                          config.SHADOWBAN_ROLLUP_INTERVAL_SECS)),
+        mod_action_db_path=os.environ.get("MOD_ACTION_DB_PATH", config.MOD_ACTION_DB_PATH),
+        mod_action_retention_days=int(os.environ.get("MOD_ACTION_RETENTION_DAYS", config.MOD_ACTION_RETENTION_DAYS)),
+        mod_action_max_rows=int(os.environ.get("MOD_ACTION_MAX_ROWS", config.MOD_ACTION_MAX_ROWS)),
+        removal_debounce_secs=int(os.environ.get("REMOVAL_DEBOUNCE_SECS", config.REMOVAL_DEBOUNCE_SECS)),
+        async_mode=int(os.environ.get("ASYNC_MODE", config.ASYNC_MODE)),
+    )
 
-    # discord stuff
-    discord_client = DiscordClient(discord_error_guild_name, discord_error_channel_name)
-    discord_client.add_commands()
-    Thread(target=discord_client.run, args=(discord_token,)).start()
-    while not discord_client.is_ready:
-        time.sleep(1)
 
-    try:
-        recorder = GoogleSheetsRecorder(discord_client)
-        reddit_handler = RedditActionsHandler(discord_client)
-        toxicity_interested = list()
-        reddit = create_reddit(bot_password, bot_username, client_id, client_secret, "modactions")
-        subreddit_trackers = dict()
-        for subreddit_name in subreddit_names:
+def start_stream_groups(discord_client, cfg, stream_groups, resources, in_group_process=False):
+    # resources gets the recorder, toxicity cache and prefilter as they're created, so they're flushed on shutdown
+    # even if a later step fails
+    # writes which sheets, discord or reddit fail are kept in the state db and replayed once they recover
+    outbound_journal = OutboundJournal(discord_client, cfg.state_db_path)
+    discord_client.set_outbound_journal(outbound_journal)
+    recorder = GoogleSheetsRecorder(discord_client, outbound_journal=outbound_journal, use_async=cfg.async_mode)
+    resources.recorder = recorder
+    checkpoint_store = CheckpointStore(cfg.state_db_path)
+    # every recorded action is also kept locally, so discord can query it without loading the sheet
+    mod_action_store = ModActionStore(cfg.mod_action_db_path, cfg.mod_action_retention_days, cfg.mod_action_max_rows)
+    discord_client.mod_action_store = mod_action_store
+    # groups on the same account share its client and its paced reddit actions. a group process only has its own
+    # group's share of the account. the client gives each thread which uses it, such as the mod log poller, the
+    # handler pool and the roster refreshes, its own praw instance
+    accounts = dict()
+    for group in stream_groups:
+        if group.username not in accounts:
+            client_id, client_secret, bot_username, bot_password = group.credentials
+            reddit = ThreadLocalReddit(partial(create_reddit, bot_password, bot_username, client_id, client_secret,
+                                               "modactions"))
+            journal_kind = "reddit" if bot_username.lower() == cfg.bot_username.lower() else f"reddit:{group.username}"
+            # the actions scheduler has its own praw instance, which nothing else uses
+            actions_reddit = create_reddit(bot_password, bot_username, client_id, client_secret, "actions")
+            accounts[group.username] = (reddit, RedditActionsHandler(discord_client, actions_reddit, outbound_journal,
+                                                                     group.budget_share if in_group_process else 1,
+                                                                     journal_kind))
+    # trackers only build lazy subreddit objects, each loads its comment mods on its own roster thread
+    subreddit_trackers = {subreddit_name.lower(): create_subreddit_tracker(accounts[group.username][0], subreddit_name)
+                          for group in stream_groups for subreddit_name in group.subreddit_names}
+    toxicity_interested = dict()
+    for group in stream_groups:
+        toxicity_interested[group.name] = list()
+        for subreddit_name in group.subreddit_names:
             settings = SettingsFactory.get_settings(subreddit_name)
-            print(f"Creating {subreddit_name} subreddit with {type(settings).__name__} settings")
-
-            subreddit_base = reddit.subreddit(subreddit_name)
-            subreddit_wilds = reddit.subreddit(settings.subreddit_wilds) if settings.subreddit_wilds else None
-            subreddit_removals = reddit.subreddit(settings.subreddit_removals) if settings.subreddit_removals else None
-            subreddit_tracker = SubredditTracker(reddit, subreddit_base, subreddit_wilds, subreddit_removals,
-                                                 settings.comment_mod_permissions, settings.comment_mod_whitelist,
-                                                 settings.discord_removals_server, settings.discord_removals_channel,
-                                                 settings.discord_bans_channel, settings.discord_shadowbans_channel,
-                                                 settings.should_message_shadowbans)
-            subreddit_trackers[subreddit_name.lower()] = subreddit_tracker
-
             if settings.google_sheet_id and settings.google_sheet_name:
                 recorder.add_sheet_for_sub(subreddit_name, settings.google_sheet_id, settings.google_sheet_name)
             if settings.check_comment_toxicity:
-                toxicity_interested.append(subreddit_name.lower())
+                toxicity_interested[group.name].append(subreddit_name.lower())
+
+    def group_trackers(group):
+        return {subreddit_name.lower(): subreddit_trackers[subreddit_name.lower()]
+                for subreddit_name in group.subreddit_names}
+
+    # the mod log doesn't need the toxicity cache or prefilter, so start it before loading them
+    if not cfg.async_mode:
+        for group in stream_groups:
+            reddit, reddit_handler = accounts[group.username]
+            create_mod_actions_thread(discord_client, recorder, reddit_handler, reddit, group_trackers(group),
+                                      checkpoint_store, mod_action_store, cfg.stream_stall_timeout_secs,
+                                      ListingPoller.BUDGET_SHARE * group.budget_share, cfg.removal_debounce_secs,
+                                      cfg.state_db_path)
+
+    shadowban_ledger = ShadowbanLedger(discord_client, cfg.state_db_path,
+                                       lambda rollups: send_shadowban_rollups(discord_client, subreddit_trackers,
+                                                                              rollups),
+                                       cfg.shadowban_cooldown_secs, cfg.shadowban_rollup_interval_secs)
+    toxicity_cache = ToxicityCache(cfg.toxicity_cache_size, cfg.toxicity_cache_ttl_secs,
+                                   cfg.toxicity_cache_path or None)
+    resources.toxicity_cache = toxicity_cache
+    metrics.set_gauge("toxicity_cache_hits", lambda: toxicity_cache.hits)
+    metrics.set_gauge("toxicity_cache_misses", lambda: toxicity_cache.misses)
+    toxicity_prefilter = None
+    if cfg.toxicity_prefilter_path:
+        # numpy is only needed when the prefilter is enabled
+        from toxicity_prefilter import ToxicityPrefilter
+        toxicity_prefilter = ToxicityPrefilter.load(cfg.toxicity_prefilter_path, cfg.toxicity_prefilter_threshold)
+        resources.toxicity_prefilter = toxicity_prefilter
+    for i, group in enumerate(stream_groups):
+        reddit, reddit_handler = accounts[group.username]
+        if cfg.async_mode:
+            # asyncpraw is only needed in async mode
+            from async_pipeline import AsyncPipeline
+            content_cache = ContentCache(reddit)
+            handler_registry = create_handler_registry(discord_client, recorder, reddit_handler, group_trackers(group),
+                                                       content_cache, mod_action_store, cfg.removal_debounce_secs,
+                                                       cfg.state_db_path)
+            pipeline = AsyncPipeline(discord_client, group.credentials, recorder, reddit_handler,
+                                     group_trackers(group), content_cache, handler_registry,
+                                     AuthorStatusCache(reddit), checkpoint_store, shadowban_ledger,
+                                     toxicity_interested[group.name], cfg.toxicity_api_key, toxicity_cache,
+                                     toxicity_prefilter, cfg.toxicity_workers, cfg.toxicity_queue_size,
+                                     cfg.toxicity_drop_policy, ListingPoller.BUDGET_SHARE * group.budget_share,
+                                     flush_sheets=i == 0)
+            pipeline.start()
+        elif toxicity_interested[group.name]:
+            client_id, client_secret, bot_username, bot_password = group.credentials
+            create_comment_thread(client_id, client_secret, bot_username, bot_password, discord_client,
+                                  reddit_handler, "+".join(toxicity_interested[group.name]), cfg.toxicity_api_key,
+                                  toxicity_cache, toxicity_prefilter, group_trackers(group), cfg.toxicity_workers,
+                                  cfg.toxicity_queue_size, cfg.toxicity_drop_policy, checkpoint_store,
+                                  shadowban_ledger, cfg.stream_stall_timeout_secs,
+                                  ListingPoller.BUDGET_SHARE * group.budget_share)
+
+
+def run_stream_group_process(group, relay_queue):
+    # entry point of a group process, runs one group's streams with discord messages relayed to the parent
+    StreamGroupProcess.handle_signals()
+    cfg = read_config()
+    # each group process has its own state file, only the mod action store is shared
+    cfg.state_db_path = group.state_path(cfg.state_db_path)
+    if cfg.toxicity_cache_path:
+        cfg.toxicity_cache_path = group.state_path(cfg.toxicity_cache_path)
+    discord_client = DiscordRelay(relay_queue)
+    resources = SimpleNamespace(recorder=None, toxicity_cache=None, toxicity_prefilter=None)
+    try:
+        start_stream_groups(discord_client, cfg, [group], resources, in_group_process=True)
+    except Exception as e:
+        message = f"Exception in {group.name} processing: {e}\n```{traceback.format_exc()}```"
+        discord_client.send_error_msg(message)
+        print(message)
+    wait_forever(resources)
+
+
+def run_forever():
+    cfg = read_config()
+    print("CONFIG: subreddit_names=" + str(cfg.subreddit_names))
+
+    if cfg.metrics_port:
+        metrics.serve(cfg.metrics_port)
 
-        create_mod_actions_thread(discord_client, recorder, reddit_handler, reddit, subreddit_trackers)
-        create_comment_thread(client_id, client_secret, bot_username, bot_password, discord_client, reddit_handler,
-                              "+".join(toxicity_interested), toxicity_api_key, subreddit_trackers)
+    # discord stuff
+    discord_client = DiscordClient(cfg.discord_error_guild_name, cfg.discord_error_channel_name)
+    discord_client.add_commands()
+    # streams don't wait for discord, messages are queued until it's connected
+    Thread(target=discord_client.run, args=(cfg.discord_token,)).start()
+
+    resources = SimpleNamespace(recorder=None, toxicity_cache=None, toxicity_prefilter=None)
+    group_processes = list()
+    try:
+        stream_groups = StreamGroup.parse(cfg.stream_groups, cfg.subreddit_names,
+                                          (cfg.client_id, cfg.client_secret, cfg.bot_username, cfg.bot_password))
+        for group in stream_groups:
+            print(f"Stream group {group}")
+        if cfg.stream_group_processes and not cfg.async_mode:
+            # each group runs in its own process, this one only runs discord and relays the groups' messages
+            outbound_journal = OutboundJournal(discord_client, cfg.state_db_path)
+            discord_client.set_outbound_journal(outbound_journal)
+            discord_client.mod_action_store = ModActionStore(cfg.mod_action_db_path, cfg.mod_action_retention_days,
+                                                             cfg.mod_action_max_rows)
+            relay_queue = PROCESS_CONTEXT.Queue()
+            Thread(target=DiscordRelay.forward_forever, args=(relay_queue, discord_client), name="DiscordRelay",
+                   daemon=True).start()
+            for group in stream_groups:
+                group_process = StreamGroupProcess(discord_client, group, run_stream_group_process, relay_queue)
+                group_process.start()
+                group_processes.append(group_process)
+        else:
+            start_stream_groups(discord_client, cfg, stream_groups, resources)
     except Exception as e:
         message = f"Exception in main processing: {e}\n```{traceback.format_exc()}```"
         discord_client.send_error_msg(message)
         print(message)
 
     # this is required as otherwise discord fails when main thread is done
-    while True:
-        time.sleep(5)
+    wait_forever(resources, group_processes)
+
+
+def wait_forever(resources, group_processes=()):
+    try:
+        while True:
+            time.sleep(5)
+    except KeyboardInterrupt:
+        print("Shutting down, flushing buffered google sheets rows and toxicity cache")
+        for group_process in group_processes:
+            group_process.stop()
+        if resources.recorder:
+            resources.recorder.close()
+        if resources.toxicity_cache:
+            print(resources.toxicity_cache.stats_summary())
+            resources.toxicity_cache.save()
+        if resources.toxicity_prefilter:
+            print(resources.toxicity_prefilter.stats_summary())
+        raise
 
 
 if __name__ == "__main__":
@@ -0,0 +1,50 @@
+from sqlite_store import SqliteStore
+
+
+class CheckpointStore(SqliteStore):
+    def __init__(self, path):
+        super(CheckpointStore, self).__init__(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS checkpoints ("
+                                "stream TEXT PRIMARY KEY, "
+                                "created_utc REAL NOT NULL, "
+                                "item_ids TEXT NOT NULL)")
+        # listing cursors, the newest item a poller has returned
+        self.connection.execute("CREATE TABLE IF NOT EXISTS cursors ("
+                                "stream TEXT PRIMARY KEY, "
+                                "cursor TEXT NOT NULL)")
+        self.connection.commit()
+        # stream -> (created_utc of newest processed item, ids of processed items with that created_utc)
+        self.checkpoints = dict()
+        for stream, created_utc, item_ids in self.connection.execute("SELECT * FROM checkpoints"):
+            self.checkpoints[stream] = (created_utc, set(item_ids.split(",")))
+        print(f"Loaded {len(self.checkpoints)} stream checkpoints from {path}")
+
+    def is_new(self, stream, created_utc, item_id, default_created_utc):
+        # streams without a checkpoint only process items newer than default_created_utc
+        with self.lock:
+            checkpoint_utc, item_ids = self.checkpoints.get(stream, (default_created_utc, set()))
+        if created_utc != checkpoint_utc:
+            return created_utc > checkpoint_utc
+        # several items can share a created_utc, only skip the ones which were actually processed
+        return item_id not in item_ids
+
+    def mark_processed(self, stream, created_utc, item_id):
+        with self.lock:
+            checkpoint_utc, item_ids = self.checkpoints.get(stream, (0, set()))
+            if created_utc < checkpoint_utc:
+                return
+            item_ids = item_ids | {item_id} if created_utc == checkpoint_utc else {item_id}
+            self.checkpoints[stream] = (created_utc, item_ids)
+            self.connection.execute("INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?)",
+                                    (stream, created_utc, ",".join(item_ids)))
+            self.connection.commit()
+
+    def get_cursor(self, stream):
+        with self.lock:
+            row = self.connection.execute("SELECT cursor FROM cursors WHERE stream = ?", (stream,)).fetchone()
+        return row[0] if row else None
+
+    def set_cursor(self, stream, cursor):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO cursors VALUES (?, ?)", (stream, cursor))
+            self.connection.commit()
@@ -7,3 +7,37 @@ DISCORD_ERROR_GUILD = 'SomeDiscord'
 DISCORD_ERROR_CHANNEL = 'SomeDiscordChannel'
 SUBREDDITS = 'SomeSubreddit,SomeOtherSubreddit'
 TOXICITY_API_KEY = 'a-key'
+# number of threads scoring comments, comments waiting to be scored, and what to drop when full
+# drop policy is one of: drop_oldest, drop_newest, block
+TOXICITY_WORKERS = 4
+TOXICITY_QUEUE_SIZE = 500
+TOXICITY_DROP_POLICY = 'drop_oldest'
+# toxicity scores are cached by a hash of the comment text, optionally persisted to TOXICITY_CACHE_PATH
+TOXICITY_CACHE_SIZE = 20000
+TOXICITY_CACHE_TTL_SECS = 604800
+TOXICITY_CACHE_PATH = ''
+# optional local model (.npz, see toxicity_prefilter.py) which skips the API for clearly benign comments
+TOXICITY_PREFILTER_PATH = ''
+TOXICITY_PREFILTER_THRESHOLD = 0.2
+# sqlite file for local bot state, such as where each stream should resume from
+STATE_DB_PATH = 'bot_state.db'
+# sqlite file of every recorded mod action, queried by the !modstats and !actions discord commands
+MOD_ACTION_DB_PATH = 'mod_actions.db'
+MOD_ACTION_RETENTION_DAYS = 365
+MOD_ACTION_MAX_ROWS = 2000000
+# streams which go this long without a poll are restarted, resuming from the last item handled
+STREAM_STALL_TIMEOUT_SECS = 300
+# subreddits sharing a mod log and comment stream, e.g. 'collapse,ufos;news'. subreddits in no group share one more.
+# group n (from 1) logs in as STREAM_GROUP_<n>_BOT_USERNAME etc. when set, groups on one account split its budget
+STREAM_GROUPS = ''
+# run each stream group in its own process
+STREAM_GROUP_PROCESSES = 0
+# run the streams, sheets writes and toxicity calls as coroutines on the discord loop instead of threads
+ASYNC_MODE = 0
+# a post's removals and approvals within this window only crosspost and ping for the last one, 0 acts on each
+REMOVAL_DEBOUNCE_SECS = 60
+# shadowbanned users get one discord notice and reply per cooldown, later comments are rolled up periodically
+SHADOWBAN_NOTICE_COOLDOWN_SECS = 604800
+SHADOWBAN_ROLLUP_INTERVAL_SECS = 3600
+# local port serving prometheus metrics at /metrics, 0 to disable
+METRICS_PORT = 9090
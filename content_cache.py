@@ -0,0 +1,74 @@
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import metrics
+
+
+class ContentCache:
+    # reddit's /api/info accepts up to 100 fullnames per request
+    MAX_BATCH_SIZE = 100
+    MAX_SIZE = 2000
+    TTL_SECS = 10 * 60
+
+    def __init__(self, reddit, max_size=MAX_SIZE, ttl_secs=TTL_SECS):
+        self.reddit = reddit
+        self.max_size = max_size
+        self.ttl_secs = ttl_secs
+        # fullname -> (expiry time, content), ordered least to most recently used
+        self.cache = OrderedDict()
+        # fullnames which should be included in the next /api/info batch
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    def queue(self, fullnames):
+        # queued at the start of each page, and always refetched, so an action never reads the reports, score or
+        # title cached for an earlier action on the same content. hits only come from the page's own batch
+        with self.lock:
+            for fullname in fullnames:
+                if fullname:
+                    self.cache.pop(fullname, None)
+                    self.pending.add(fullname)
+
+    def get(self, fullname):
+        with self.lock:
+            content = self._get_cached(fullname)
+            if content is not None:
+                return content
+            self.pending.add(fullname)
+        self.fetch_pending()
+        with self.lock:
+            return self._get_cached(fullname)
+
+    def fetch_pending(self):
+        for batch in self.take_pending():
+            print(f"Fetching {len(batch)} items from /api/info")
+            with metrics.timed("reddit"):
+                contents = list(self.reddit.info(fullnames=batch))
+            for content in contents:
+                self.put(content.fullname, content)
+
+    def take_pending(self):
+        # the queued fullnames in /api/info sized batches, for the caller to fetch
+        with self.lock:
+            fullnames = list(self.pending)
+            self.pending.clear()
+        return [fullnames[i:i + self.MAX_BATCH_SIZE] for i in range(0, len(fullnames), self.MAX_BATCH_SIZE)]
+
+    def put(self, fullname, content):
+        with self.lock:
+            self.cache[fullname] = (time.monotonic() + self.ttl_secs, content)
+            self.cache.move_to_end(fullname)
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+
+    def _get_cached(self, fullname):
+        entry = self.cache.get(fullname)
+        if entry is None:
+            return None
+        expiry, content = entry
+        if expiry < time.monotonic():
+            del self.cache[fullname]
+            return None
+        self.cache.move_to_end(fullname)
+        return content
@@ -1,13 +1,24 @@
 import asyncio
+import io
+import threading
 import typing
+from datetime import datetime
 
 import discord
 from discord.ext import commands
 
+from metrics import metrics
+from profiler import Profiler
 from settings import Settings
 
 
 class DiscordClient(commands.Bot):
+    # messages to the same channel within this window are merged into as few sends as possible
+    COALESCE_WINDOW_SECS = 2
+    MAX_MESSAGE_LENGTH = 2000
+    REPLAY_TIMEOUT_SECS = 60
+    RECENT_ACTIONS_LIMIT = 10
+
     def __init__(self, error_guild_name, error_guild_channel):
         super().__init__('!', intents=discord.Intents.all())
         self.error_guild_name = error_guild_name
@@ -15,6 +26,55 @@ class DiscordClient(commands.Bot):
         self.error_guild = None
         self.error_channel = None
         self.is_ready = False
+        # (guild name, channel name) -> channel, only used on the discord loop
+        self.channel_cache = dict()
+        # (guild name, channel name) -> messages waiting to be sent, filled from any thread
+        self.pending_messages = dict()
+        self.pending_lock = threading.Lock()
+        # messages discord fails to take are spilled here, when set
+        self.outbound_journal = None
+        # answers !modstats and !actions, when set
+        self.mod_action_store = None
+        self.profiler = Profiler()
+        # coroutine functions to run on the discord loop, queued until it exists
+        self.startup_tasks = list()
+        self.loop_ready = threading.Event()
+        metrics.set_gauge("queue_depth", self.pending_count, queue="discord_messages")
+
+    def set_outbound_journal(self, outbound_journal):
+        self.outbound_journal = outbound_journal
+        outbound_journal.register("discord", self.replay_msg)
+
+    def replay_msg(self, payload):
+        # called by the outbound journal's thread, raises so the message is kept until discord takes it
+        if not self.is_ready:
+            raise RuntimeError("Discord is not connected yet")
+        asyncio.run_coroutine_threadsafe(self.send_replayed(payload['guild'], payload['channel'], payload['message']),
+                                         self.loop).result(self.REPLAY_TIMEOUT_SECS)
+
+    async def send_replayed(self, guild_name, channel_name, message):
+        channel = self.get_channel_by_name(guild_name, channel_name)
+        if not channel:
+            print(f"Dropping replayed message, unable to find {guild_name}/{channel_name}")
+            return
+        with metrics.timed("discord"):
+            await channel.send(message)
+
+    async def setup_hook(self):
+        self.loop.create_task(self.send_pending_forever())
+        with self.pending_lock:
+            self.loop_ready.set()
+            startup_tasks, self.startup_tasks = self.startup_tasks, list()
+        for coroutine_function in startup_tasks:
+            self.loop.create_task(coroutine_function())
+
+    def start_task(self, coroutine_function):
+        # runs coroutine_function() on the discord loop, from any thread and whether or not discord has started
+        with self.pending_lock:
+            if not self.loop_ready.is_set():
+                self.startup_tasks.append(coroutine_function)
+                return
+        self.loop.call_soon_threadsafe(lambda: self.loop.create_task(coroutine_function()))
 
     async def on_ready(self):
         print(f'{self.user} has connected to Discord!')
@@ -27,23 +87,201 @@ class DiscordClient(commands.Bot):
         print(startup_message)
         await self.error_channel.send(f"I am online for SubredditWilds script, is_dry_run={Settings.is_dry_run}")
 
+    async def on_guild_channel_create(self, channel):
+        self.channel_cache.clear()
+
+    async def on_guild_channel_delete(self, channel):
+        self.channel_cache.clear()
+
+    async def on_guild_channel_update(self, before, after):
+        self.channel_cache.clear()
+
+    async def on_guild_update(self, before, after):
+        self.channel_cache.clear()
+
+    async def on_guild_join(self, guild):
+        self.channel_cache.clear()
+
+    async def on_guild_remove(self, guild):
+        self.channel_cache.clear()
+
     def send_error_msg(self, message):
         full_message = f"SubredditWilds script has had an exception. This can normally be ignored, " \
                        f"but if it's occurring frequently, may indicate a script error.\n{message}"
-        if self.error_channel:
-            asyncio.run_coroutine_threadsafe(self.error_channel.send(full_message), self.loop)
+        self.queue_msg(self.error_guild_name, self.error_channel_name, full_message)
 
     def send_msg(self, guild_name, channel_name, message):
         print(f"Adding post to {guild_name}/{channel_name}: {message}")
         if Settings.is_dry_run:
             print("\tDRY RUN!!!")
             return
-        guild = discord.utils.get(self.guilds, name=guild_name)
-        channel = discord.utils.get(guild.channels, name=channel_name)
-        if channel:
-            asyncio.run_coroutine_threadsafe(channel.send(message), self.loop)
+        self.queue_msg(guild_name, channel_name, message)
+
+    def queue_msg(self, guild_name, channel_name, message):
+        # safe to call from any thread, messages are sent by send_pending_forever on the discord loop
+        with self.pending_lock:
+            self.pending_messages.setdefault((guild_name, channel_name), list()).append(message)
+
+    def pending_count(self):
+        with self.pending_lock:
+            return sum(len(messages) for messages in self.pending_messages.values())
+
+    def get_channel_by_name(self, guild_name, channel_name):
+        key = (guild_name, channel_name)
+        if key not in self.channel_cache:
+            guild = discord.utils.get(self.guilds, name=guild_name)
+            channel = discord.utils.get(guild.channels, name=channel_name) if guild else None
+            if not channel:
+                return None
+            self.channel_cache[key] = channel
+        return self.channel_cache[key]
+
+    async def send_pending_forever(self):
+        await self.wait_until_ready()
+        while not self.is_closed():
+            await asyncio.sleep(self.COALESCE_WINDOW_SECS)
+            with self.pending_lock:
+                pending_messages = self.pending_messages
+                self.pending_messages = dict()
+            # one failed channel never stops the sender, its messages are already requeued or spilled
+            results = await asyncio.gather(*[self.send_coalesced(guild_name, channel_name, messages)
+                                             for (guild_name, channel_name), messages in pending_messages.items()],
+                                           return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception):
+                    print(f"Failed to send coalesced discord messages: {result}")
+
+    async def send_coalesced(self, guild_name, channel_name, messages):
+        channel = self.get_channel_by_name(guild_name, channel_name)
+        if not channel:
+            print(f"Dropping {len(messages)} messages, unable to find {guild_name}/{channel_name}")
+            return
+        chunks = self.coalesce(messages)
+        for i, chunk in enumerate(chunks):
+            try:
+                # discord.py waits out this channel's rate limit bucket itself
+                with metrics.timed("discord"):
+                    await channel.send(chunk)
+            except (discord.Forbidden, discord.NotFound) as e:
+                print(f"Dropping message to {guild_name}/{channel_name}, unable to send: {e}")
+            except Exception as e:
+                # HTTP errors, but also dropped connections and timeouts
+                print(f"Failed to send to {guild_name}/{channel_name}, retrying: {e}")
+                metrics.inc("retries_total", dependency="discord")
+                self.channel_cache.pop((guild_name, channel_name), None)
+                if self.outbound_journal:
+                    # kept on disk and retried with backoff until discord recovers
+                    for chunk in chunks[i:]:
+                        self.outbound_journal.spill("discord", {'guild': guild_name, 'channel': channel_name,
+                                                                'message': chunk})
+                    return
+                # put the unsent messages back at the front of the queue, they are retried next window
+                with self.pending_lock:
+                    key = (guild_name, channel_name)
+                    self.pending_messages[key] = chunks[i:] + self.pending_messages.get(key, list())
+                return
+
+    def coalesce(self, messages):
+        chunks = list()
+        for message in messages:
+            for part in self.split_message(message):
+                if chunks and len(chunks[-1]) + 1 + len(part) <= self.MAX_MESSAGE_LENGTH:
+                    chunks[-1] = f"{chunks[-1]}\n{part}"
+                else:
+                    chunks.append(part)
+        return chunks
+
+    def split_message(self, message):
+        # prefer splitting on newlines, only cutting mid-line when a single line is too long
+        parts = list()
+        while len(message) > self.MAX_MESSAGE_LENGTH:
+            split_at = message.rfind("\n", 0, self.MAX_MESSAGE_LENGTH)
+            if split_at <= 0:
+                split_at = self.MAX_MESSAGE_LENGTH
+            parts.append(message[:split_at])
+            message = message[split_at:].lstrip("\n")
+        parts.append(message)
+        return parts
 
     def add_commands(self):
+        @self.command(name="stats", brief="Show latency, lag, queue and throughput metrics",
+                      description="Summarises per-dependency call latency (reddit, sheets, discord, toxicity), "
+                                  "stream lag, queue depths, retries and handler throughput since startup. "
+                                  "The full metrics are also served in prometheus format on METRICS_PORT",
+                      usage="!stats")
+        async def stats(ctx):
+            for chunk in self.split_message(f"```{metrics.summary()}```"):
+                await ctx.channel.send(chunk)
+
+        @self.command(name="modstats", brief="Count a mod's actions over the last days",
+                      description="Counts every recorded action of the mod in the last days (default 30), "
+                                  "per subreddit and action type",
+                      usage="!modstats some_mod 30")
+        async def modstats(ctx, mod_name: str, days: int = 30):
+            if not self.mod_action_store:
+                await ctx.channel.send("Mod actions aren't being stored")
+                return
+            rows = await asyncio.to_thread(self.mod_action_store.mod_stats, mod_name, days)
+            lines = [f"r/{subreddit} {action}: {count}" for subreddit, action, count in rows]
+            summary = "\n".join(lines) if lines else "No actions"
+            for chunk in self.split_message(f"```{mod_name} in the last {days} days:\n{summary}```"):
+                await ctx.channel.send(chunk)
+
+        @self.command(name="actions", brief="Count and list a subreddit's actions of one type",
+                      description="Counts the subreddit's recorded actions of this type in the last days "
+                                  "(default 30) per mod, and lists the latest few",
+                      usage="!actions collapse removelink 30")
+        async def actions(ctx, subreddit_name: str, action: str, days: int = 30):
+            if not self.mod_action_store:
+                await ctx.channel.send("Mod actions aren't being stored")
+                return
+            counts = await asyncio.to_thread(self.mod_action_store.action_counts, subreddit_name, action, days)
+            recent = await asyncio.to_thread(self.mod_action_store.recent_actions, subreddit_name, action,
+                                             self.RECENT_ACTIONS_LIMIT)
+            lines = [f"{action} in r/{subreddit_name} in the last {days} days:"]
+            lines += [f"{mod}: {count}" for mod, count in counts] if counts else ["No actions"]
+            if recent:
+                lines.append("Latest:")
+                lines += [f"{datetime.utcfromtimestamp(created_utc).isoformat(' ')} {mod} {link} {details}".rstrip()
+                          for created_utc, mod, link, details in recent]
+            for chunk in self.split_message("```" + "\n".join(lines) + "```"):
+                await ctx.channel.send(chunk)
+
+        @self.command(name="profile", brief="Sample every thread's stack for some seconds",
+                      description="Samples the stacks of all bot threads for the seconds (default 30, at most 300) "
+                                  "and sends them as a collapsed stack file, for flamegraph.pl or speedscope.app. "
+                                  "Samples are wall clock, so waiting threads show up too",
+                      usage="!profile 30")
+        async def profile(ctx, seconds: int = 30):
+            if not 0 < seconds <= Profiler.MAX_SECS:
+                await ctx.channel.send(f"Seconds must be between 1 and {Profiler.MAX_SECS}")
+                return
+            await ctx.channel.send(f"Profiling for {seconds} seconds")
+            result = await asyncio.to_thread(self.profiler.sample, seconds)
+            if result is None:
+                await ctx.channel.send("A profile is already running")
+                return
+            collapsed, sample_count = result
+            file_name = f"profile-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.collapsed"
+            await ctx.channel.send(f"{sample_count} samples of every thread",
+                                   file=discord.File(io.BytesIO(collapsed.encode('utf-8')), filename=file_name))
+
+        @self.command(name="allocations", brief="Show which lines allocated the most memory over some seconds",
+                      description="Traces allocations with tracemalloc for the seconds (default 30, at most 300) "
+                                  "and lists the lines whose held memory grew the most",
+                      usage="!allocations 30")
+        async def allocations(ctx, seconds: int = 30):
+            if not 0 < seconds <= Profiler.MAX_SECS:
+                await ctx.channel.send(f"Seconds must be between 1 and {Profiler.MAX_SECS}")
+                return
+            await ctx.channel.send(f"Tracing allocations for {seconds} seconds")
+            result = await asyncio.to_thread(self.profiler.allocation_diff, seconds)
+            if result is None:
+                await ctx.channel.send("A profile is already running")
+                return
+            for chunk in self.split_message(f"```{result}```"):
+                await ctx.channel.send(chunk)
+
         @self.command(name="ping", description="lol")
         async def ping(ctx):
             prefix = "DRY RUN" if Settings.is_dry_run else "DO REAL SHIT"
@@ -1,15 +1,20 @@
 from __future__ import print_function
 
-import gc
+import asyncio
+import queue
 import traceback
 import os.path
 import time
-from datetime import datetime, timezone
+from datetime import datetime
+from threading import Event, Lock, Thread
+from urllib.parse import quote
 
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+from metrics import metrics
+from outbound_journal import ReplayDeferred
 from settings import Settings
 
 
@@ -22,16 +27,55 @@ class MonitoredSubreddit:
 
 class GoogleSheetsRecorder:
     SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+    # rows are buffered per sheet and sent as one append once either limit is reached
+    MAX_BATCH_ROWS = 50
+    MAX_BATCH_AGE_SECS = 30
+    _STOP = object()
+    SHEETS_API_URL = "https://sheets.googleapis.com/v4/spreadsheets"
+    ASYNC_DRAIN_INTERVAL_SECS = 0.5
+    ASYNC_TIMEOUT_SECS = 30
 
-    def __init__(self, discord_client):
+    def __init__(self, discord_client, max_batch_rows=MAX_BATCH_ROWS, max_batch_age_secs=MAX_BATCH_AGE_SECS,
+                 outbound_journal=None, use_async=False):
         self.discord_client = discord_client
-        self.creds = self.get_credentials()
-        self.service = build('sheets', 'v4', credentials=self.creds)
-        self.startup_timestamp = datetime.now(timezone.utc).timestamp()
+        # batches which fail are spilled here instead of retried on the flush thread
+        self.outbound_journal = outbound_journal
+        if outbound_journal:
+            outbound_journal.register("sheets", self.replay_batch)
+        # credentials and the sheets client are created on first use, so startup never waits on google
+        self.creds = None
+        self._service = None
+        self.connect_lock = Lock()
         self.monitored_subs = {}
-        
-        # force gc to clean up response objects
-        gc.collect()
+        self.max_batch_rows = max_batch_rows
+        self.max_batch_age_secs = max_batch_age_secs
+
+        # mod action threads only enqueue rows, all sheets calls happen on the flush thread
+        # or, with use_async, in flush_forever_async on an event loop
+        self.row_queue = queue.Queue()
+        self.flush_thread = None
+        self.flushed = Event()
+        if not use_async:
+            self.flush_thread = Thread(target=self.flush_forever, name="GoogleSheetsFlush", daemon=True)
+            self.flush_thread.start()
+        metrics.set_gauge("queue_depth", self.row_queue.qsize, queue="sheets_rows")
+
+    @property
+    def service(self):
+        creds = self.fresh_credentials()
+        with self.connect_lock:
+            if self._service is None:
+                # the discovery document shipped with googleapiclient, rather than fetching it on every start
+                self._service = build('sheets', 'v4', credentials=creds, static_discovery=True, cache_discovery=False)
+            return self._service
+
+    def fresh_credentials(self):
+        with self.connect_lock:
+            if self.creds is None:
+                self.creds = self.get_credentials()
+            if self.creds.expired:
+                self.creds.refresh(Request())
+            return self.creds
 
     def add_sheet_for_sub(self, subreddit_name, sheet_id, sheet_name):
         print(f"Adding google sheet recording for {subreddit_name}")
@@ -39,37 +83,175 @@ class GoogleSheetsRecorder:
         self.monitored_subs[subreddit_name.lower()] = monitored_sub
 
     def append_to_sheet(self, subreddit_name, created_utc, mod_name, action, link, details):
+        self.row_queue.put((subreddit_name, created_utc, mod_name, action, link, details))
+
+    def close(self, timeout_secs=30):
+        # flush everything still buffered, used on shutdown
+        self.row_queue.put(self._STOP)
+        if self.flush_thread:
+            self.flush_thread.join(timeout_secs)
+        else:
+            self.flushed.wait(timeout_secs)
+
+    def flush_forever(self):
+        # connect in the background while the first rows are buffering
+        try:
+            self.service
+        except Exception as e:
+            message = f"Exception when connecting to google sheets: {e}\n```{traceback.format_exc()}```"
+            self.discord_client.send_error_msg(message)
+            print(message)
+
+        # (sheet_id, sheet_name) -> (time first row was buffered, rows)
+        pending = {}
+        while True:
+            timeout = None
+            if pending:
+                oldest = min(first_time for first_time, _ in pending.values())
+                timeout = max(0, oldest + self.max_batch_age_secs - time.monotonic())
+            try:
+                item = self.row_queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is self._STOP:
+                for key in list(pending.keys()):
+                    self.flush_batch(pending, key)
+                return
+            if item is not None:
+                self.buffer_row(pending, *item)
+
+            for key in self.due_batches(pending):
+                self.flush_batch(pending, key)
+
+    async def flush_forever_async(self, session):
+        # the flush thread's batching on an event loop, rows are appended with aiohttp so sheets calls for
+        # different tabs are in flight at once
+        pending = {}
+        while True:
+            await asyncio.sleep(self.ASYNC_DRAIN_INTERVAL_SECS)
+            stopping = False
+            while not stopping:
+                try:
+                    item = self.row_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stopping = True
+                else:
+                    self.buffer_row(pending, *item)
+            keys = list(pending.keys()) if stopping else self.due_batches(pending)
+            await asyncio.gather(*[self.flush_batch_async(session, pending, key) for key in keys])
+            if stopping:
+                self.flushed.set()
+                return
+
+    def due_batches(self, pending):
+        now = time.monotonic()
+        return [key for key, (first_time, rows) in pending.items()
+                if len(rows) >= self.max_batch_rows or now - first_time >= self.max_batch_age_secs]
+
+    def buffer_row(self, pending, subreddit_name, created_utc, mod_name, action, link, details):
         subreddit_name = subreddit_name.lower()
         if subreddit_name not in self.monitored_subs:
             print(f"Ignoring mod action as unmonitored sub: {subreddit_name}")
             return
         monitored_sub = self.monitored_subs[subreddit_name]
-        sheet_id = monitored_sub.sheet_id
-        sheet_name = monitored_sub.sheet_name
 
-        # this is required on startup to prevent re-actioning startup stream
-        if created_utc <= self.startup_timestamp:
-            return
+        key = (monitored_sub.sheet_id, monitored_sub.sheet_name)
+        if key not in pending:
+            pending[key] = (time.monotonic(), [])
+        pending[key][1].append(self.format_row(created_utc, mod_name, action, link, details))
 
+    @staticmethod
+    def format_row(created_utc, mod_name, action, link, details):
         dt_utc = datetime.utcfromtimestamp(created_utc)
         formatted_dt = dt_utc.isoformat().replace('T', ' ')
-        values = [[formatted_dt, mod_name, action, link, details]]
+        return [formatted_dt, mod_name, action, link, details]
 
-        self.append_to_sheet_helper(sheet_id, sheet_name, values)
-        
-        # force gc to clean up response objects
-        gc.collect()
+    def read_rows(self, sheet_id, sheet_name):
+        # dates come back as serial numbers (days since 1899-12-30) when sheets parsed them as dates
+        with metrics.timed("sheets"):
+            response = self.service.spreadsheets().values().get(
+                spreadsheetId=sheet_id,
+                range=f'{sheet_name}!A:E',
+                valueRenderOption='UNFORMATTED_VALUE',
+                dateTimeRenderOption='SERIAL_NUMBER').execute()
+        return response.get('values', [])
 
-    def append_to_sheet_helper(self, sheet_id, sheet_name, values):
+    def flush_batch(self, pending, key):
+        _, rows = pending.pop(key)
+        sheet_id, sheet_name = key
         if Settings.is_dry_run:
             print("\tDRY RUN!!!")
             return
+        # with a journal, one attempt is made so an outage doesn't hold up the rows buffering behind this batch
+        max_retries = 1 if self.outbound_journal else 4
+        try:
+            written = self.append_to_sheet_helper(sheet_id, sheet_name, rows, max_retries=max_retries)
+        except Exception as e:
+            written = False
+            message = f"Exception when flushing {len(rows)} rows to {sheet_name}: {e}\n```{traceback.format_exc()}```"
+            self.discord_client.send_error_msg(message)
+            print(message)
+        if not written and self.outbound_journal:
+            self.outbound_journal.spill("sheets", {'sheet_id': sheet_id, 'sheet_name': sheet_name, 'rows': rows})
 
-        if self.creds.expired:
-            self.creds.refresh(Request())
+    async def flush_batch_async(self, session, pending, key):
+        _, rows = pending.pop(key)
+        sheet_id, sheet_name = key
+        if Settings.is_dry_run:
+            print("\tDRY RUN!!!")
+            return
+        try:
+            written = await self.append_rows_async(session, sheet_id, sheet_name, rows)
+        except Exception as e:
+            written = False
+            message = f"Exception when flushing {len(rows)} rows to {sheet_name}: {e}\n```{traceback.format_exc()}```"
+            self.discord_client.send_error_msg(message)
+            print(message)
+        if not written and self.outbound_journal:
+            # the journal writes to sqlite, off the loop
+            await asyncio.to_thread(self.outbound_journal.spill, "sheets",
+                                    {'sheet_id': sheet_id, 'sheet_name': sheet_name, 'rows': rows})
+
+    async def append_rows_async(self, session, sheet_id, sheet_name, values):
+        # the same append as append_to_sheet_helper, as one attempt against the REST endpoint
+        # aiohttp comes with asyncpraw, which is only needed in async mode
+        import aiohttp
+        creds = await asyncio.to_thread(self.fresh_credentials)
+        request_range = f'{sheet_name}!A:E'
+        url = f"{self.SHEETS_API_URL}/{sheet_id}/values/{quote(request_range)}:append"
+        with metrics.timed("sheets"):
+            async with session.post(url, params={'valueInputOption': 'USER_ENTERED'},
+                                    headers={'Authorization': f"Bearer {creds.token}"},
+                                    json={'range': request_range, 'values': values, 'majorDimension': 'ROWS'},
+                                    timeout=aiohttp.ClientTimeout(total=self.ASYNC_TIMEOUT_SECS)) as response:
+                if response.status == 200:
+                    metrics.inc("sheets_rows_total", len(values))
+                    return True
+                error = await response.text()
+        message = f'Google API exception for {len(values)} rows: {response.status} {error}'
+        print(message)
+        if response.status not in [500, 503]:
+            self.discord_client.send_error_msg(message)
+        return False
+
+    def replay_batch(self, payload):
+        if Settings.is_dry_run:
+            # kept in the journal until dry run is turned off, rather than dropped as if it was written
+            raise ReplayDeferred("dry run")
+        if not self.append_to_sheet_helper(payload['sheet_id'], payload['sheet_name'], payload['rows'],
+                                           max_retries=1):
+            raise RuntimeError(f"Unable to append {len(payload['rows'])} rows to {payload['sheet_name']}")
+
+    def append_to_sheet_helper(self, sheet_id, sheet_name, values, max_retries=4):
+        # returns whether the rows were written
+        if Settings.is_dry_run:
+            print("\tDRY RUN!!!")
+            return False
 
         message = ""
-        max_retries = 4
         initial_backoff_time_secs = 5
         last_error_status = 0
         for i in range(max_retries):
@@ -80,14 +262,16 @@ class GoogleSheetsRecorder:
                     'values': values,
                     'majorDimension': 'ROWS'
                 }
-                self.service.spreadsheets().values().append(
-                    spreadsheetId=sheet_id,
-                    range=request_range,
-                    valueInputOption='USER_ENTERED',
-                    body=request_body).execute()
-                return
+                with metrics.timed("sheets"):
+                    self.service.spreadsheets().values().append(
+                        spreadsheetId=sheet_id,
+                        range=request_range,
+                        valueInputOption='USER_ENTERED',
+                        body=request_body).execute()
+                metrics.inc("sheets_rows_total", len(values))
+                return True
             except HttpError as error:
-                message = f'Google API exception for {str(values)}: {str(error)}\n```{traceback.format_exc()}```'
+                message = f'Google API exception for {len(values)} rows: {str(error)}\n```{traceback.format_exc()}```'
                 print(message)
                 last_error_status = error.resp.status
 
@@ -95,13 +279,17 @@ class GoogleSheetsRecorder:
                     print(f'The credentials have been revoked or expired, refreshing again?')
                     self.creds.refresh(Request())
 
+                if i + 1 == max_retries:
+                    break
                 backoff_time_secs = initial_backoff_time_secs ** i
                 print(f'Retrying in {backoff_time_secs} seconds...')
+                metrics.inc("retries_total", dependency="sheets")
                 time.sleep(backoff_time_secs)
 
         if last_error_status not in [500, 503]:
             self.discord_client.send_error_msg(message)
         print(f'Failed to update google sheets after {max_retries} retries.')
+        return False
 
     def get_credentials(self):
         # if env var set, assume this is a bot, otherwise authenticate user
@@ -0,0 +1,120 @@
+import threading
+import time
+import traceback
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from metrics import metrics
+
+
+class RegisteredHandler:
+    def __init__(self, name, callback, action_types, mods, excluded_mods, serial):
+        self.name = name
+        self.callback = callback
+        # serial handlers see every action in order, not just the actions for one target
+        self.serial = serial
+        # None means every action type/mod
+        self.action_types = set(action_types) if action_types else None
+        self.mods = {mod.lower() for mod in mods} if mods else None
+        self.excluded_mods = {mod.lower() for mod in excluded_mods} if excluded_mods else set()
+
+    def wants_mod(self, mod_name):
+        mod_name = mod_name.lower()
+        if mod_name in self.excluded_mods:
+            return False
+        return self.mods is None or mod_name in self.mods
+
+
+class HandlerRegistry:
+    MAX_WORKERS = 4
+    # recent (handler name, action id) dispatches remembered, well over a page of actions per handler
+    MAX_DISPATCHED = 10000
+
+    def __init__(self, discord_client, max_workers=MAX_WORKERS):
+        self.discord_client = discord_client
+        self.handlers = list()
+        # action type -> handlers registered for it, plus handlers which want every action type
+        self.index = dict()
+        self.all_action_handlers = list()
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix="ModActionHandler")
+        # (handler name, target), or (handler name,) for serial handlers -> calls waiting behind the one running
+        self.ordered_queues = dict()
+        self.lock = threading.Lock()
+        # (handler name, action id) -> future of its call. a stalled stream's replacement refetches the page its
+        # stale worker already dispatched, it waits on those calls rather than running them again
+        self.dispatched = OrderedDict()
+        self.dispatch_lock = threading.Lock()
+
+    def register(self, name, callback, action_types=None, mods=None, excluded_mods=None, serial=False):
+        self.handlers.append(RegisteredHandler(name, callback, action_types, mods, excluded_mods, serial))
+        self.index = dict()
+        self.all_action_handlers = list()
+        for handler in self.handlers:
+            if handler.action_types is None:
+                self.all_action_handlers.append(handler)
+                continue
+            for action_type in handler.action_types:
+                self.index.setdefault(action_type, list()).append(handler)
+
+    def handlers_for(self, action):
+        mod_name = str(action.mod)
+        return [handler for handler in self.index.get(action.action, list()) + self.all_action_handlers
+                if handler.wants_mod(mod_name)]
+
+    def dispatch(self, action):
+        # handlers run in parallel, but each handler sees the actions for one target in order
+        target = getattr(action, 'target_fullname', None) or action.id
+        futures = list()
+        with self.dispatch_lock:
+            for handler in self.handlers_for(action):
+                key = (handler.name, action.id)
+                future = self.dispatched.get(key)
+                # a call cancelled before it started never ran
+                if future is None or future.cancelled():
+                    future = self.submit_ordered((handler.name,) if handler.serial else (handler.name, target),
+                                                 lambda handler=handler: self.run(handler, action))
+                    self.dispatched[key] = future
+                    while len(self.dispatched) > self.MAX_DISPATCHED:
+                        self.dispatched.popitem(last=False)
+                futures.append(future)
+        return futures
+
+    def run(self, handler, action):
+        start_time = time.monotonic()
+        try:
+            handler.callback(action)
+            metrics.inc("handled_total", handler=handler.name)
+        except Exception as e:
+            metrics.inc("handler_errors_total", handler=handler.name)
+            message = f"Exception when handling action {action.id} for {action.subreddit} in {handler.name}: " \
+                      f"{e}\n```{traceback.format_exc()}```"
+            self.discord_client.send_error_msg(message)
+            print(message)
+        finally:
+            metrics.observe("handler_seconds", time.monotonic() - start_time, handler=handler.name)
+
+    def submit_ordered(self, key, callback):
+        future = Future()
+        with self.lock:
+            if key in self.ordered_queues:
+                self.ordered_queues[key].append((callback, future))
+                return future
+            self.ordered_queues[key] = deque([(callback, future)])
+        self.executor.submit(self.drain, key)
+        return future
+
+    def drain(self, key):
+        while True:
+            with self.lock:
+                queue = self.ordered_queues[key]
+                if not queue:
+                    del self.ordered_queues[key]
+                    return
+                callback, future = queue.popleft()
+            if not future.set_running_or_notify_cancel():
+                # cancelled while waiting, e.g. by an async page which timed out
+                continue
+            try:
+                future.set_result(callback())
+            except Exception as e:
+                future.set_exception(e)
@@ -0,0 +1,155 @@
+import asyncio
+import time
+
+from metrics import metrics
+from resilient_thread import ResilientThread, heartbeat
+
+
+class ListingPoller:
+    PAGE_SIZE = 100
+    MIN_INTERVAL_SECS = 2
+    MAX_INTERVAL_SECS = 30
+    # poll often enough that a typical poll returns about this many items, well under a page
+    TARGET_ITEMS_PER_POLL = 10
+    # weight of the latest poll in the moving average of items per second
+    RATE_SMOOTHING = 0.3
+    # most of the rate limit budget is left for lookups and outbound actions
+    BUDGET_SHARE = 0.25
+    # a removed or expired cursor returns nothing forever, so empty polls re-check it this often
+    CURSOR_CHECK_EMPTY_POLLS = 3
+
+    def __init__(self, reddit, listing, cursor_attribute, cursor=None, on_cursor=None,
+                 min_interval_secs=MIN_INTERVAL_SECS, max_interval_secs=MAX_INTERVAL_SECS, budget_share=BUDGET_SHARE):
+        self.reddit = reddit
+        # called as listing(limit=..., params=...), returning items newest first, e.g. subreddit.mod.log
+        self.listing = listing
+        # attribute reddit accepts as a "before" cursor, "id" for mod actions, "fullname" for things
+        self.cursor_attribute = cursor_attribute
+        # newest item already returned, polls only fetch items newer than this
+        self.cursor = cursor
+        # called with the new cursor after each page is returned, so it can be persisted
+        self.on_cursor = on_cursor
+        self.min_interval_secs = min_interval_secs
+        self.max_interval_secs = max_interval_secs
+        self.budget_share = budget_share
+        self.items_per_sec = 0
+        self.last_poll_time = None
+        self.empty_polls = 0
+
+    def pages(self):
+        # yields each poll's new items oldest first, forever
+        while True:
+            items = self.poll()
+            # before handling the items, so a worker abandoned as stalled in poll() never handles what it fetched.
+            # handlers also call heartbeat() per item, for stalls part way through a page
+            heartbeat()
+            if items:
+                yield items
+                self.advance_cursor(items)
+            interval_secs = self.next_interval_secs(len(items))
+            heartbeat(interval_secs)
+            time.sleep(interval_secs)
+
+    def poll(self):
+        steps = self.poll_steps()
+        try:
+            request = next(steps)
+            while True:
+                request = steps.send(self.fetch(*request))
+        except StopIteration as stop:
+            return stop.value
+
+    def fetch(self, limit, params=None):
+        with metrics.timed("reddit"):
+            return list(self.listing(limit=limit, params=params))
+
+    def poll_steps(self):
+        # the polling shared by the sync and async pollers, which only differ in how they fetch. yields each
+        # (limit, params) to fetch and is sent back that page newest first, returns the new items oldest first
+        if self.cursor is None:
+            return (yield from self.latest_steps())
+        items = list()
+        cursor = self.cursor
+        while True:
+            page = yield self.PAGE_SIZE, {"before": cursor}
+            page.reverse()
+            items.extend(page)
+            # a full page means more built up since the last poll, keep catching up instead of skipping
+            if len(page) < self.PAGE_SIZE:
+                break
+            cursor = getattr(page[-1], self.cursor_attribute)
+            print(f"Catching up, fetched {len(items)} items so far")
+
+        if not items and self.empty_polls % self.CURSOR_CHECK_EMPTY_POLLS == 0:
+            # an expired or deleted cursor also returns nothing, fall back to the latest page if so and let the
+            # checkpoints filter out what was already handled
+            latest = yield 1, None
+            if latest and getattr(latest[0], self.cursor_attribute) != self.cursor:
+                print(f"Cursor {self.cursor} returned nothing, restarting from the latest page")
+                items = yield from self.latest_steps()
+        self.empty_polls = 0 if items else self.empty_polls + 1
+        return items
+
+    def latest_steps(self):
+        items = yield self.PAGE_SIZE, None
+        items.reverse()
+        return items
+
+    def advance_cursor(self, items):
+        self.cursor = getattr(items[-1], self.cursor_attribute)
+        if self.on_cursor:
+            self.on_cursor(self.cursor)
+
+    def next_interval_secs(self, item_count):
+        now = time.monotonic()
+        if self.last_poll_time is not None:
+            latest_rate = item_count / max(now - self.last_poll_time, 0.001)
+            self.items_per_sec = self.RATE_SMOOTHING * latest_rate + (1 - self.RATE_SMOOTHING) * self.items_per_sec
+        self.last_poll_time = now
+
+        interval_secs = self.TARGET_ITEMS_PER_POLL / self.items_per_sec if self.items_per_sec else \
+            self.max_interval_secs
+        interval_secs = min(max(interval_secs, self.min_interval_secs), self.max_interval_secs)
+        return max(interval_secs, self.budget_interval_secs())
+
+    def budget_interval_secs(self):
+        # slowest rate which keeps polling within its share of the remaining rate limit budget
+        limits = self.reddit.auth.limits
+        remaining = limits.get('remaining')
+        reset_timestamp = limits.get('reset_timestamp')
+        if remaining is None or reset_timestamp is None:
+            return 0
+        secs_to_reset = max(reset_timestamp - time.time(), 0)
+        return secs_to_reset / max(remaining * self.budget_share, 1)
+
+
+class AsyncListingPoller(ListingPoller):
+    # the same polling for async listings, e.g. asyncpraw's subreddit.mod.log, run on an event loop
+    # nothing on the loop calls heartbeat(), a poll taking longer than this raises instead so the task is restarted
+    POLL_TIMEOUT_SECS = ResilientThread.STALL_TIMEOUT_SECS
+
+    def __init__(self, *args, poll_timeout_secs=POLL_TIMEOUT_SECS, **kwargs):
+        super(AsyncListingPoller, self).__init__(*args, **kwargs)
+        self.poll_timeout_secs = poll_timeout_secs
+
+    async def pages(self):
+        while True:
+            items = await asyncio.wait_for(self.poll(), self.poll_timeout_secs)
+            if items:
+                yield items
+                # on_cursor writes to sqlite, which mustn't block the loop
+                await asyncio.to_thread(self.advance_cursor, items)
+            await asyncio.sleep(self.next_interval_secs(len(items)))
+
+    async def poll(self):
+        steps = self.poll_steps()
+        try:
+            request = next(steps)
+            while True:
+                request = steps.send(await self.fetch(*request))
+        except StopIteration as stop:
+            return stop.value
+
+    async def fetch(self, limit, params=None):
+        with metrics.timed("reddit"):
+            return [item async for item in self.listing(limit=limit, params=params)]
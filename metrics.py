@@ -0,0 +1,170 @@
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                self.bucket_counts[i] += 1
+                break
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the q'th observation, good enough to spot a slow dependency
+        target = q * self.count
+        cumulative = 0
+        for bucket, bucket_count in zip(self.buckets, self.bucket_counts):
+            cumulative += bucket_count
+            if cumulative >= target:
+                return bucket
+        return float('inf')
+
+
+class Metrics:
+    LATENCY_BUCKETS_SECS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    LAG_BUCKETS_SECS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (name, labels) -> value, labels being a sorted tuple of (label, value) pairs
+        self.counters = dict()
+        self.histograms = dict()
+        # (name, labels) -> callable returning the current value, read when metrics are rendered
+        self.gauges = dict()
+        self.server = None
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS_SECS, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(buckets)
+            self.histograms[key].observe(value)
+
+    def set_gauge(self, name, callback, **labels):
+        with self.lock:
+            self.gauges[self.key(name, labels)] = callback
+
+    @contextmanager
+    def timed(self, dependency):
+        # latency of one call to an external dependency (reddit, sheets, discord, toxicity)
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe("external_call_seconds", time.monotonic() - start_time, dependency=dependency)
+
+    def observe_lag(self, stream, created_utc):
+        self.observe("stream_lag_seconds", max(time.time() - created_utc, 0), self.LAG_BUCKETS_SECS, stream=stream)
+
+    def read_gauges(self):
+        with self.lock:
+            gauges = dict(self.gauges)
+        values = dict()
+        for key, callback in gauges.items():
+            try:
+                values[key] = callback()
+            except Exception as e:
+                print(f"Failed to read gauge {key[0]}: {e}")
+        return values
+
+    @staticmethod
+    def format_labels(labels, extra=()):
+        labels = list(labels) + list(extra)
+        if not labels:
+            return ''
+        escaped = [(label, str(value).replace('\\', '\\\\').replace('"', '\\"')) for label, value in labels]
+        return "{" + ",".join(f'{label}="{value}"' for label, value in escaped) + "}"
+
+    def render(self):
+        # prometheus text exposition format
+        lines = list()
+        gauges = self.read_gauges()
+        with self.lock:
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} counter")
+                    typed.add(name)
+                lines.append(f"{name}{self.format_labels(labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} histogram")
+                    typed.add(name)
+                cumulative = 0
+                for bucket, bucket_count in zip(histogram.buckets, histogram.bucket_counts):
+                    cumulative += bucket_count
+                    lines.append(f"{name}_bucket{self.format_labels(labels, [('le', bucket)])} {cumulative}")
+                lines.append(f"{name}_bucket{self.format_labels(labels, [('le', '+Inf')])} {histogram.count}")
+                lines.append(f"{name}_sum{self.format_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{self.format_labels(labels)} {histogram.count}")
+        for (name, labels), value in sorted(gauges.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} gauge")
+                typed.add(name)
+            lines.append(f"{name}{self.format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        # short human readable version for discord
+        lines = list()
+        gauges = self.read_gauges()
+        with self.lock:
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if not histogram.count:
+                    continue
+                label_text = ", ".join(str(value) for _, value in labels)
+                lines.append(f"{name} [{label_text}]: n={histogram.count}, "
+                             f"avg={histogram.sum / histogram.count:.3f}s, "
+                             f"p50<={histogram.quantile(0.5)}s, p95<={histogram.quantile(0.95)}s")
+            for (name, labels), value in sorted(self.counters.items()):
+                label_text = ", ".join(str(value) for _, value in labels)
+                lines.append(f"{name} [{label_text}]: {value}")
+        for (name, labels), value in sorted(gauges.items()):
+            label_text = ", ".join(str(value) for _, value in labels)
+            lines.append(f"{name} [{label_text}]: {value}")
+        return "\n".join(lines) if lines else "No metrics recorded yet"
+
+    def serve(self, port, host="127.0.0.1"):
+        metrics = self
+
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        threading.Thread(target=self.server.serve_forever, name="Metrics", daemon=True).start()
+        print(f"Serving metrics on http://{host}:{port}/metrics")
+
+
+# shared by every module, like Settings.is_dry_run
+metrics = Metrics()
@@ -0,0 +1,91 @@
+import threading
+import time
+
+from metrics import metrics
+from sqlite_store import SqliteStore
+
+
+class ModActionStore(SqliteStore):
+    RETENTION_DAYS = 365
+    MAX_ROWS = 2000000
+    COMPACT_INTERVAL_SECS = 6 * 60 * 60
+
+    def __init__(self, path, retention_days=RETENTION_DAYS, max_rows=MAX_ROWS):
+        # lets compaction hand deleted pages back to the disk
+        super(ModActionStore, self).__init__(path, pragmas=["auto_vacuum=INCREMENTAL"])
+        self.retention_days = retention_days
+        self.max_rows = max_rows
+        self.connection.execute("CREATE TABLE IF NOT EXISTS mod_actions ("
+                                "id TEXT PRIMARY KEY, "
+                                "subreddit TEXT NOT NULL, "
+                                "mod TEXT NOT NULL COLLATE NOCASE, "
+                                "action TEXT NOT NULL, "
+                                "created_utc REAL NOT NULL, "
+                                "link TEXT, "
+                                "details TEXT)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS mod_actions_by_sub_mod "
+                                "ON mod_actions (subreddit, mod, action, created_utc)")
+        # !modstats is across subs and !actions across mods, so each gets an index it can range scan
+        self.connection.execute("CREATE INDEX IF NOT EXISTS mod_actions_by_mod ON mod_actions (mod, created_utc)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS mod_actions_by_sub_action "
+                                "ON mod_actions (subreddit, action, created_utc)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS mod_actions_by_time ON mod_actions (created_utc)")
+        self.connection.commit()
+        self.compact_thread = threading.Thread(target=self.compact_forever, name="ModActionStoreCompact", daemon=True)
+        self.compact_thread.start()
+
+    def record(self, action_id, subreddit_name, created_utc, mod_name, action, link, details):
+        # ids are unique, so actions seen again after a restart or by a backfill are only stored once
+        with self.lock:
+            self.connection.execute("INSERT OR IGNORE INTO mod_actions VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    (action_id, subreddit_name.lower(), mod_name, action, created_utc, link, details))
+            self.connection.commit()
+
+    def mod_stats(self, mod_name, days):
+        # (subreddit, action, count) for every action the mod made in the last days
+        since_utc = time.time() - days * 24 * 60 * 60
+        with self.lock, metrics.timed("mod_action_store"):
+            return self.connection.execute("SELECT subreddit, action, COUNT(*) AS count FROM mod_actions "
+                                           "WHERE mod = ? AND created_utc >= ? "
+                                           "GROUP BY subreddit, action ORDER BY count DESC",
+                                           (mod_name, since_utc)).fetchall()
+
+    def action_counts(self, subreddit_name, action, days):
+        # (mod, count) of the sub's actions of this type in the last days
+        since_utc = time.time() - days * 24 * 60 * 60
+        with self.lock, metrics.timed("mod_action_store"):
+            return self.connection.execute("SELECT mod, COUNT(*) AS count FROM mod_actions "
+                                           "WHERE subreddit = ? AND action = ? AND created_utc >= ? "
+                                           "GROUP BY mod ORDER BY count DESC",
+                                           (subreddit_name.lower(), action, since_utc)).fetchall()
+
+    def recent_actions(self, subreddit_name, action, limit):
+        # (created_utc, mod, link, details) of the sub's latest actions of this type
+        with self.lock, metrics.timed("mod_action_store"):
+            return self.connection.execute("SELECT created_utc, mod, link, details FROM mod_actions "
+                                           "WHERE subreddit = ? AND action = ? "
+                                           "ORDER BY created_utc DESC LIMIT ?",
+                                           (subreddit_name.lower(), action, limit)).fetchall()
+
+    def compact_forever(self):
+        while True:
+            try:
+                self.compact()
+            except Exception as e:
+                print(f"Failed to compact mod action store {self.path}: {e}")
+            time.sleep(self.COMPACT_INTERVAL_SECS)
+
+    def compact(self):
+        cutoff_utc = time.time() - self.retention_days * 24 * 60 * 60
+        with self.lock:
+            expired = self.connection.execute("DELETE FROM mod_actions WHERE created_utc < ?",
+                                              (cutoff_utc,)).rowcount
+            count = self.connection.execute("SELECT COUNT(*) FROM mod_actions").fetchone()[0]
+            excess = max(count - self.max_rows, 0)
+            if excess:
+                self.connection.execute("DELETE FROM mod_actions WHERE id IN ("
+                                        "SELECT id FROM mod_actions ORDER BY created_utc LIMIT ?)", (excess,))
+            self.connection.commit()
+            self.connection.execute("PRAGMA incremental_vacuum")
+        print(f"Compacted mod action store, removed {expired} expired and {excess} excess actions, "
+              f"{count - excess} remaining")
@@ -0,0 +1,180 @@
+import re
+import time
+import traceback
+
+import requests
+
+from author_status_cache import AuthorStatusCache
+from metrics import metrics
+from records import CommentRecord, ModActionRecord
+
+# the mod log and comment handling shared by the threaded streams in bot.py and the async pipeline
+
+# mod actions whose target content is looked up, both for automod reports and removal crossposts
+CONTENT_ACTIONS = ["approvecomment", "removecomment", "approvelink", "removelink"]
+TOXICITY_API_URL = "https://api.moderatehatespeech.com/api/v1/moderate/"
+TOXICITY_API_TIMEOUT_SECS = 10
+TOXICITY_REPORT_THRESHOLD = 0.85
+
+
+def new_mod_actions(checkpoint_store, content_cache, actions, startup_utc):
+    actions = [ModActionRecord.from_praw(action) for action in actions]
+    # without a usable cursor the latest page is returned, only handle what wasn't processed before
+    actions = [action for action in actions
+               if checkpoint_store.is_new(mod_action_stream_name(action), action.created_utc, action.id, startup_utc)]
+    for action in actions:
+        metrics.observe_lag("modlog", action.created_utc)
+    # fetch every target of this poll in as few /api/info requests as possible
+    content_cache.queue([action.target_fullname for action in actions if action.action in CONTENT_ACTIONS])
+    return actions
+
+
+def prefetch_targets(content_cache):
+    try:
+        content_cache.fetch_pending()
+    except Exception as e:
+        # handlers fetch whatever is missing themselves
+        print(f"Failed to prefetch mod action targets: {e}")
+
+
+def mark_mod_actions_processed(checkpoint_store, actions):
+    for action in actions:
+        checkpoint_store.mark_processed(mod_action_stream_name(action), action.created_utc, action.id)
+
+
+def mod_action_stream_name(action):
+    return f"modlog:{action.subreddit.lower()}"
+
+
+def new_comments(checkpoint_store, comments, startup_utc):
+    comments = [CommentRecord.from_praw(comment) for comment in comments]
+    # without a usable cursor the latest page is returned, only handle what wasn't processed before
+    comments = [comment for comment in comments
+                if checkpoint_store.is_new(comment_stream_name(comment), comment.created_utc, comment.id,
+                                           startup_utc)]
+    for comment in comments:
+        metrics.observe_lag("comments", comment.created_utc)
+    return comments
+
+
+def mark_comment_processed(checkpoint_store, comment):
+    checkpoint_store.mark_processed(comment_stream_name(comment), comment.created_utc, comment.id)
+
+
+def comment_stream_name(comment):
+    return f"comments:{comment.subreddit.lower()}"
+
+
+def handle_comment(discord_client, reddit_handler, comment, subreddit_trackers, author_status_cache,
+                   shadowban_ledger=None):
+    try:
+        handle_shadowbanned_users(discord_client, reddit_handler, comment, subreddit_trackers, author_status_cache,
+                                  shadowban_ledger)
+    except Exception as e:
+        message = f"Exception when handling comment {comment.id}: {e}\n```{traceback.format_exc()}```"
+        discord_client.send_error_msg(message)
+        print(message)
+
+
+def handle_shadowbanned_users(discord_client, reddit_handler, comment, subreddit_trackers, author_status_cache,
+                              shadowban_ledger=None):
+    # suspended users are treated the same as shadowbanned, their comments are also only visible to mods
+    if author_status_cache.get_status(comment) != AuthorStatusCache.OK:
+        respond_to_shadowban(discord_client, reddit_handler, comment, subreddit_trackers, shadowban_ledger)
+
+
+def respond_to_shadowban(discord_client, reddit_handler, comment, subreddit_trackers, shadowban_ledger=None):
+    # a user gets one notice and reply per cooldown, their later comments are rolled up into a periodic update
+    if shadowban_ledger and comment.author and \
+            not shadowban_ledger.should_notify(comment.subreddit, comment.author, comment.permalink):
+        return
+    subreddit_tracker = subreddit_trackers[comment.subreddit.lower()]
+    discord_channel = subreddit_tracker.discord_shadowbans_channel
+    if discord_channel:
+        message = f"Shadowbanned user comment: https://www.reddit.com{comment.permalink}"
+        discord_client.send_msg(subreddit_tracker.discord_removals_server, discord_channel, message)
+    if subreddit_tracker.should_message_shadowbans:
+        message = (f"Hi, you appear to be shadow banned by reddit. "
+                   f"A shadow ban is a form of ban when reddit silently removes your content without your "
+                   f"knowledge. Only reddit admins and moderators of the community you're commenting in can see"
+                   f" the content, unless they manually approve it.\n\nThis is not a ban by "
+                   f"{comment.subreddit_name_prefixed}, and the mod team cannot help you reverse the ban. "
+                   f"We recommend visiting r/ShadowBan to confirm you're banned and how to appeal.\n\n"
+                   f"We hope knowing this can help you.\n\n"
+                   f"This is a bot - responses and messages are not monitored. "
+                   f"If it appears to be wrong, [please modmail us]"
+                   f"(https://www.reddit.com/message/compose?to=/r/collapse&subject=Shadowban Bot Error).")
+        reddit_handler.write_removal_reason_custom(comment, message)
+
+
+def handle_toxic_comments(discord_client, reddit_handler, toxicity_api_key, toxicity_cache, toxicity_prefilter,
+                          comment):
+    try:
+        # clearly benign comments are never sent to the toxicity API
+        if toxicity_prefilter and toxicity_prefilter.is_benign(comment.body):
+            return
+        result = determine_toxicity(comment.body, toxicity_api_key, toxicity_cache)
+        report_if_toxic(reddit_handler, comment, result)
+    except Exception as e:
+        message = f"Exception when handling toxic comment {comment.id}: {e}\n```{traceback.format_exc()}```"
+        discord_client.send_error_msg(message)
+        print(message)
+
+
+def report_if_toxic(reddit_handler, comment, result):
+    if result > TOXICITY_REPORT_THRESHOLD:
+        percent = round(result * 100)
+        print(f'Comment ({comment.permalink}) reported @ {percent}% confidence')
+        reddit_handler.report_content(f"Automatic report for toxicity @ {percent}% confidence", comment)
+
+
+def toxicity_text(text):
+    text = re.sub(r'>[^\n]+', "", text)  # strip out quotes
+    if re.match(r'^\s*$', text) is not None:
+        # the comment was just quotes and/or whitespace
+        return None
+    return text
+
+
+def cached_toxicity(toxicity_cache, text):
+    # copy-pasted text is only ever sent to the API once. None if it hasn't been scored yet
+    if not toxicity_cache:
+        return None
+    return toxicity_cache.get(toxicity_cache.key_for(text))
+
+
+def toxicity_score(response):
+    return float(response['confidence']) if response['class'] == "flag" else 0
+
+
+def cache_toxicity(toxicity_cache, text, score, api_latency_secs):
+    if not toxicity_cache:
+        return
+    toxicity_cache.put(toxicity_cache.key_for(text), score, api_latency_secs)
+    if toxicity_cache.api_calls % 1000 == 0:
+        print(toxicity_cache.stats_summary())
+
+
+def determine_toxicity(text, toxicity_api_key, toxicity_cache=None):
+    # don't even try to error handle this, the API sends back weird stuff all the time
+    try:
+        """ Call API and return response list with boolean & confidence score """
+        text = toxicity_text(text)
+        if text is None:
+            return 0
+
+        cached_score = cached_toxicity(toxicity_cache, text)
+        if cached_score is not None:
+            return cached_score
+
+        start_time = time.monotonic()
+        with metrics.timed("toxicity"):
+            response = requests.post(TOXICITY_API_URL,
+                                     json={"token": toxicity_api_key, "text": text},
+                                     timeout=TOXICITY_API_TIMEOUT_SECS).json()
+
+        score = toxicity_score(response)
+        cache_toxicity(toxicity_cache, text, score, time.monotonic() - start_time)
+        return score
+    except Exception as e:
+        return 0
@@ -0,0 +1,115 @@
+import json
+import threading
+import time
+import traceback
+
+from metrics import metrics
+from sqlite_store import SqliteStore
+
+
+class ReplayDeferred(Exception):
+    # raised by a replayer which mustn't send right now, e.g. in dry run. the entry stays queued and this doesn't
+    # count as a failed attempt
+    pass
+
+
+class OutboundJournal(SqliteStore):
+    INITIAL_BACKOFF_SECS = 5
+    MAX_BACKOFF_SECS = 10 * 60
+    # entries still failing after this many replays are assumed to be bad requests rather than outages
+    MAX_ATTEMPTS = 20
+    DEFERRED_RETRY_SECS = 60
+
+    def __init__(self, discord_client, path):
+        super(OutboundJournal, self).__init__(path)
+        self.discord_client = discord_client
+        self.condition = threading.Condition(self.lock)
+        # writes which failed against sheets, discord or reddit, replayed in id order per kind
+        self.connection.execute("CREATE TABLE IF NOT EXISTS outbound ("
+                                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                                "kind TEXT NOT NULL, "
+                                "payload TEXT NOT NULL, "
+                                "attempts INTEGER NOT NULL DEFAULT 0)")
+        self.connection.commit()
+        # kind -> callback which replays a payload, raising if the dependency is still failing
+        self.replayers = dict()
+        # kind -> (monotonic time of next replay, current backoff)
+        self.backoffs = dict()
+        self.drainer = threading.Thread(target=self.drain_forever, name="OutboundJournal", daemon=True)
+        self.drainer.start()
+        metrics.set_gauge("queue_depth", self.depth, queue="outbound_journal")
+        pending = self.depth()
+        if pending:
+            print(f"Loaded {pending} unsent outbound writes from {path}")
+
+    def register(self, kind, replayer):
+        with self.condition:
+            self.replayers[kind] = replayer
+            self.condition.notify()
+
+    def spill(self, kind, payload):
+        # never blocks on the failing dependency, only on the local disk
+        with self.condition:
+            self.connection.execute("INSERT INTO outbound (kind, payload) VALUES (?, ?)", (kind, json.dumps(payload)))
+            self.connection.commit()
+            self.condition.notify()
+        metrics.inc("spilled_total", kind=kind)
+        print(f"Spilled failed {kind} write to the outbound journal")
+
+    def depth(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM outbound").fetchone()[0]
+
+    def drain_forever(self):
+        while True:
+            entry = self.next_entry()
+            self.replay(*entry)
+
+    def next_entry(self):
+        # oldest entry of any kind which isn't backing off, waiting until there is one
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                ready_kinds = [kind for kind in self.replayers
+                               if self.backoffs.get(kind, (0, 0))[0] <= now]
+                for kind in ready_kinds:
+                    row = self.connection.execute("SELECT id, payload, attempts FROM outbound WHERE kind = ? "
+                                                  "ORDER BY id LIMIT 1", (kind,)).fetchone()
+                    if row:
+                        return (kind,) + row
+                waits = [next_time - now for next_time, _ in self.backoffs.values() if next_time > now]
+                self.condition.wait(min(waits) if waits else None)
+
+    def replay(self, kind, entry_id, payload, attempts):
+        try:
+            self.replayers[kind](json.loads(payload))
+        except ReplayDeferred as e:
+            print(f"Deferred replaying {kind} writes for {self.DEFERRED_RETRY_SECS} seconds: {e}")
+            with self.condition:
+                self.backoffs[kind] = (time.monotonic() + self.DEFERRED_RETRY_SECS, 0)
+            return
+        except Exception as e:
+            attempts += 1
+            _, backoff_secs = self.backoffs.get(kind, (0, 0))
+            backoff_secs = min(max(backoff_secs * 2, self.INITIAL_BACKOFF_SECS), self.MAX_BACKOFF_SECS)
+            print(f"Failed to replay {kind} write (attempt {attempts}), retrying in {backoff_secs} seconds: {e}")
+            with self.condition:
+                self.backoffs[kind] = (time.monotonic() + backoff_secs, backoff_secs)
+                if attempts < self.MAX_ATTEMPTS:
+                    self.connection.execute("UPDATE outbound SET attempts = ? WHERE id = ?", (attempts, entry_id))
+                else:
+                    self.connection.execute("DELETE FROM outbound WHERE id = ?", (entry_id,))
+                self.connection.commit()
+            if attempts >= self.MAX_ATTEMPTS:
+                message = f"Dropping {kind} write after {attempts} failed replays: {e}\n" \
+                          f"```{traceback.format_exc()}```\n{payload}"
+                self.discord_client.send_error_msg(message)
+                print(message)
+            return
+
+        # the dependency has recovered, the rest of this kind's backlog is sent without waiting
+        with self.condition:
+            self.backoffs.pop(kind, None)
+            self.connection.execute("DELETE FROM outbound WHERE id = ?", (entry_id,))
+            self.connection.commit()
+        metrics.inc("replayed_total", kind=kind)
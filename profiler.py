@@ -0,0 +1,83 @@
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+
+class Profiler:
+    # on demand, nothing is hooked or traced between runs
+    SAMPLE_INTERVAL_SECS = 0.01
+    MAX_SECS = 5 * 60
+    # frames kept per allocation, more shows where allocations come from but costs memory while tracing
+    TRACEMALLOC_FRAMES = 10
+    TOP_ALLOCATIONS = 20
+
+    def __init__(self, sample_interval_secs=SAMPLE_INTERVAL_SECS):
+        self.sample_interval_secs = sample_interval_secs
+        # one run at a time, runs from discord commands report if another is still going
+        self.lock = threading.Lock()
+
+    def sample(self, seconds):
+        # wall clock samples of every other thread's stack, in collapsed format: one line per distinct stack,
+        # "thread;outer frame;...;inner frame count", which flamegraph.pl and speedscope read. None if busy
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            own_ident = threading.get_ident()
+            stacks = Counter()
+            thread_names = dict()
+            sample_count = 0
+            deadline = time.monotonic() + self.duration_secs(seconds)
+            while time.monotonic() < deadline:
+                frames = sys._current_frames()
+                if frames.keys() - thread_names.keys():
+                    # threads come and go as streams restart
+                    thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for ident, frame in frames.items():
+                    if ident != own_ident:
+                        stacks[self.collapse(thread_names.get(ident, str(ident)), frame)] += 1
+                sample_count += 1
+                time.sleep(self.sample_interval_secs)
+            collapsed = "\n".join(f"{stack} {count}" for stack, count in stacks.most_common())
+            return collapsed, sample_count
+        finally:
+            self.lock.release()
+
+    def duration_secs(self, seconds):
+        return max(0, min(seconds, self.MAX_SECS))
+
+    @staticmethod
+    def collapse(thread_name, frame):
+        names = list()
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        names.append(thread_name)
+        # semicolons separate frames in the collapsed format
+        return ";".join(reversed(names))
+
+    def allocation_diff(self, seconds):
+        # the lines which allocated the most memory still held after the seconds, None if busy
+        if not self.lock.acquire(blocking=False):
+            return None
+        started = not tracemalloc.is_tracing()
+        try:
+            if started:
+                tracemalloc.start(self.TRACEMALLOC_FRAMES)
+            before = tracemalloc.take_snapshot()
+            time.sleep(self.duration_secs(seconds))
+            after = tracemalloc.take_snapshot()
+            filters = [tracemalloc.Filter(False, tracemalloc.__file__),
+                       tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")]
+            stats = after.filter_traces(filters).compare_to(before.filter_traces(filters), 'lineno')
+            current, peak = tracemalloc.get_traced_memory()
+            lines = [f"Traced {current / 1024 / 1024:.1f} MiB, peak {peak / 1024 / 1024:.1f} MiB"]
+            lines += [str(stat) for stat in stats[:self.TOP_ALLOCATIONS]]
+            return "\n".join(lines)
+        finally:
+            if started:
+                tracemalloc.stop()
+            self.lock.release()
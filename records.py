@@ -0,0 +1,59 @@
+import sys
+from dataclasses import dataclass
+
+
+# praw objects are converted to these as soon as they're read, so handlers only ever see plain fields which were
+# in the listing response. praw's lazy attributes can fetch on access. only fields something reads are kept, and
+# the few distinct subreddit, mod and action names are interned, so queued records share one copy of each
+
+
+@dataclass(frozen=True, slots=True)
+class ModActionRecord:
+    id: str
+    subreddit: str
+    mod: str
+    action: str
+    details: str
+    created_utc: float
+    target_fullname: str
+    target_permalink: str
+    target_author: str
+
+    @classmethod
+    def from_praw(cls, action):
+        return cls(id=action.id,
+                   subreddit=sys.intern(str(action.subreddit)),
+                   mod=sys.intern(str(action.mod)),
+                   action=sys.intern(action.action),
+                   details=getattr(action, 'details', None) or '',
+                   created_utc=action.created_utc,
+                   target_fullname=getattr(action, 'target_fullname', None) or '',
+                   target_permalink=getattr(action, 'target_permalink', None) or '',
+                   target_author=getattr(action, 'target_author', None) or '')
+
+
+@dataclass(frozen=True, slots=True)
+class CommentRecord:
+    id: str
+    fullname: str
+    subreddit: str
+    subreddit_name_prefixed: str
+    # None for deleted authors
+    author: str | None
+    author_fullname: str | None
+    body: str
+    permalink: str
+    created_utc: float
+
+    @classmethod
+    def from_praw(cls, comment):
+        subreddit = comment.subreddit.display_name
+        return cls(id=comment.id,
+                   fullname=f"t1_{comment.id}",
+                   subreddit=sys.intern(subreddit),
+                   subreddit_name_prefixed=sys.intern(f"r/{subreddit}"),
+                   author=comment.author.name if comment.author else None,
+                   author_fullname=getattr(comment, 'author_fullname', None),
+                   body=comment.body,
+                   permalink=comment.permalink,
+                   created_utc=comment.created_utc)
@@ -1,56 +1,210 @@
+import heapq
+import itertools
+import threading
 import time
 import traceback
+from concurrent.futures import Future
 
 from praw.exceptions import RedditAPIException
 
+from metrics import metrics
+from outbound_journal import ReplayDeferred
 from settings import Settings
 
 
+class ScheduledAction:
+    def __init__(self, priority, sequence, description, payload, spill):
+        self.priority = priority
+        self.sequence = sequence
+        self.description = description
+        # json safe description of the action, spilled to the outbound journal if reddit keeps failing it
+        self.payload = payload
+        self.spill = spill
+        self.future = Future()
+        self.attempts = 0
+        self.not_before = 0
+
+    def __lt__(self, other):
+        return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+
 class RedditActionsHandler:
-    def __init__(self, discord_client):
+    # lower priorities are sent first
+    PRIORITY_MODERATION = 0
+    PRIORITY_REPLY = 1
+    PRIORITY_CROSSPOST = 2
+    # gap between calls when reddit hasn't told us our remaining budget yet
+    DEFAULT_CALL_GAP_SECS = 2
+    MIN_CALL_GAP_SECS = 0.5
+    MAX_RETRIES = 3
+    INITIAL_BACKOFF_TIME_SECS = 5
+
+    def __init__(self, discord_client, reddit, outbound_journal=None, budget_share=1, journal_kind="reddit"):
         self.discord_client = discord_client
+        self.outbound_journal = outbound_journal
+        # each account's failed actions are journaled under their own kind, so they're replayed as that account
+        self.journal_kind = journal_kind
+        # used to read the rate limit headers of our account's most recent responses, and to build actions. praw
+        # isn't thread safe, so this is only used on the worker thread and shouldn't be shared with anything else
+        self.reddit = reddit
+        # fraction of the account's budget to use, when other processes send actions from the same account
+        self.budget_share = budget_share
         self.last_call_time = 0
+        self.sequence = itertools.count()
+        self.ready = list()
+        self.delayed = list()
+        self.condition = threading.Condition()
+        self.worker = threading.Thread(target=self.work_forever, name="RedditActions", daemon=True)
+        self.worker.start()
+        # one handler per account, each account has its own journal kind
+        metrics.set_gauge("queue_depth", self.queue_depth, queue="reddit_actions", account=journal_kind)
+        if outbound_journal:
+            outbound_journal.register(journal_kind, self.replay)
 
     def add_post(self, sub, url, title):
         print(f"Adding post to {sub}: {title}")
-        self.reddit_call(lambda: sub.submit(title, url=url, send_replies=False))
+        return self.schedule(self.PRIORITY_CROSSPOST, f"add post to {sub}",
+                             {'action': 'add_post', 'subreddit': str(sub), 'url': url, 'title': title})
 
     def write_removal_reason_custom(self, content, reason):
-        print(f"Writing removal comment for {str(content)}: {reason}")
-        comment = self.reddit_call(lambda: content.reply(reason))
-        self.reddit_call(lambda: comment.mod.distinguish(sticky=True), reddit_throttle_secs=1)
-        self.reddit_call(lambda: comment.mod.lock(), reddit_throttle_secs=1)
+        print(f"Writing removal comment for {content.fullname}: {reason}")
+        return self.schedule(self.PRIORITY_REPLY, f"removal comment for {content.fullname}",
+                             {'action': 'removal_comment', 'fullname': content.fullname, 'reason': reason})
 
     def remove_content(self, removal_reason, content):
         print(f"Removing content, reason: {removal_reason}")
-        self.reddit_call(lambda: content.mod.remove(mod_note=removal_reason))
+        return self.schedule(self.PRIORITY_MODERATION, f"remove {content.fullname}",
+                             {'action': 'remove', 'fullname': content.fullname, 'reason': removal_reason})
 
     def report_content(self, report_reason, content):
         print(f"Reporting content, reason: {report_reason}")
-        self.reddit_call(lambda: content.report(report_reason))
+        return self.schedule(self.PRIORITY_MODERATION, f"report {content.fullname}",
+                             {'action': 'report', 'fullname': content.fullname, 'reason': report_reason})
 
-    def reddit_call(self, callback, reddit_throttle_secs=5):
+    def schedule(self, priority, description, payload, spill=True):
+        # never blocks, the returned future resolves once the action has been sent to reddit. only the payload is
+        # queued, the praw objects it acts on are built on the worker thread
+        action = ScheduledAction(priority, next(self.sequence), description, payload, spill)
+        with self.condition:
+            heapq.heappush(self.ready, action)
+            self.condition.notify()
+        return action.future
+
+    def replay(self, payload):
+        # called by the outbound journal, not spilled again as the journal keeps it until this succeeds
         if Settings.is_dry_run:
-            print("\tDRY RUN!!!")
-            return
-        # throttle reddit calls to prevent reddit throttling
-        elapsed_time = time.time() - self.last_call_time
-        if elapsed_time < reddit_throttle_secs:
-            time.sleep(reddit_throttle_secs - elapsed_time)
+            # kept in the journal until dry run is turned off, rather than dropped as if it was sent
+            raise ReplayDeferred("dry run")
+        self.schedule(self.PRIORITY_MODERATION, f"replayed {payload['action']}", payload, spill=False).result()
+
+    def callback_for(self, payload):
+        # actions are sent on lazy objects built from names, so they never fetch what they act on
+        if payload['action'] == 'add_post':
+            sub = self.reddit.subreddit(payload['subreddit'])
+            return lambda: sub.submit(payload['title'], url=payload['url'], send_replies=False)
+        content = self.content_for(payload['fullname'])
+        if payload['action'] == 'removal_comment':
+            return lambda: self.reply(content, payload['reason'])
+        if payload['action'] == 'distinguish_lock':
+            return lambda: self.distinguish_lock(content)
+        if payload['action'] == 'remove':
+            return lambda: content.mod.remove(mod_note=payload['reason'])
+        return lambda: content.report(payload['reason'])
+
+    def reply(self, content, reason):
+        # distinguishing and locking is its own action, so retrying it never posts the reply again
+        comment = content.reply(reason)
+        self.schedule(self.PRIORITY_REPLY, f"distinguish and lock {comment.fullname}",
+                      {'action': 'distinguish_lock', 'fullname': comment.fullname})
+        return comment
+
+    def distinguish_lock(self, comment):
+        # both are idempotent, so this is safe to retry as a whole
+        comment.mod.distinguish(sticky=True)
+        self.wait_for_budget()
+        comment.mod.lock()
 
+    def content_for(self, fullname):
+        if fullname.startswith("t1_"):
+            return self.reddit.comment(id=fullname[3:])
+        return self.reddit.submission(id=fullname[3:])
+
+    def queue_depth(self):
+        with self.condition:
+            return len(self.ready) + len(self.delayed)
+
+    def next_action(self):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                # retries wait out their backoff without holding up other actions
+                for action in [action for action in self.delayed if action.not_before <= now]:
+                    self.delayed.remove(action)
+                    heapq.heappush(self.ready, action)
+                if self.ready:
+                    return heapq.heappop(self.ready)
+                timeout = min(action.not_before for action in self.delayed) - now if self.delayed else None
+                self.condition.wait(timeout)
+
+    def work_forever(self):
+        while True:
+            action = self.next_action()
+            if Settings.is_dry_run:
+                print(f"\tDRY RUN!!! Skipping {action.description}")
+                action.future.set_result(None)
+                continue
+            self.wait_for_budget()
+            self.run(action)
+
+    def run(self, action):
         # retry reddit exceptions, such as throttling or reddit issues
-        max_retries = 3
-        initial_backoff_time_secs = 5
-        for i in range(max_retries):
-            try:
-                result = callback()
-                self.last_call_time = time.time()
-                return result
-            except RedditAPIException as e:
-                message = f"Reddit API exception: {e}\n```{traceback.format_exc()}```"
-                self.discord_client.send_error_msg(message)
-                print(message)
-
-                backoff_time_secs = initial_backoff_time_secs ** i
-                print(f'Retrying in {backoff_time_secs} seconds...')
-                time.sleep(backoff_time_secs)
+        action.attempts += 1
+        try:
+            with metrics.timed("reddit"):
+                result = self.callback_for(action.payload)()
+            action.future.set_result(result)
+        except RedditAPIException as e:
+            message = f"Reddit API exception: {e}\n```{traceback.format_exc()}```"
+            self.discord_client.send_error_msg(message)
+            print(message)
+            if action.attempts >= self.MAX_RETRIES:
+                self.fail(action, e)
+                return
+            backoff_time_secs = self.INITIAL_BACKOFF_TIME_SECS ** (action.attempts - 1)
+            print(f'Retrying {action.description} in {backoff_time_secs} seconds...')
+            metrics.inc("retries_total", dependency="reddit")
+            action.not_before = time.monotonic() + backoff_time_secs
+            with self.condition:
+                self.delayed.append(action)
+        except Exception as e:
+            message = f"Exception when sending {action.description}: {e}\n```{traceback.format_exc()}```"
+            self.discord_client.send_error_msg(message)
+            print(message)
+            self.fail(action, e)
+        finally:
+            self.last_call_time = time.monotonic()
+
+    def fail(self, action, e):
+        # the journal retries the action once reddit recovers, rather than it being dropped
+        if action.spill and self.outbound_journal:
+            self.outbound_journal.spill(self.journal_kind, action.payload)
+        action.future.set_exception(e)
+
+    def call_gap_secs(self):
+        # spread our remaining budget evenly over the time until reddit resets it
+        limits = self.reddit.auth.limits
+        remaining = limits.get('remaining')
+        reset_timestamp = limits.get('reset_timestamp')
+        if remaining is None or reset_timestamp is None:
+            return self.DEFAULT_CALL_GAP_SECS / self.budget_share
+        secs_to_reset = max(reset_timestamp - time.time(), 0)
+        if remaining < 1:
+            return secs_to_reset
+        return max(secs_to_reset / (remaining * self.budget_share), self.MIN_CALL_GAP_SECS)
+
+    def wait_for_budget(self):
+        elapsed_time = time.monotonic() - self.last_call_time
+        gap_secs = self.call_gap_secs()
+        if elapsed_time < gap_secs:
+            time.sleep(gap_secs - elapsed_time)
+        self.last_call_time = time.monotonic()
@@ -0,0 +1,92 @@
+import dataclasses
+import json
+import threading
+import time
+import traceback
+
+from metrics import metrics
+from records import ModActionRecord
+from sqlite_store import SqliteStore
+
+
+class RemovalDebouncer(SqliteStore):
+    # removals and approvals of a post are held this long, only the last one is acted on
+    DEBOUNCE_SECS = 60
+    CHECK_INTERVAL_SECS = 1
+
+    def __init__(self, discord_client, path, subreddit_names, on_settled, debounce_secs=DEBOUNCE_SECS):
+        super(RemovalDebouncer, self).__init__(path)
+        self.discord_client = discord_client
+        # only this stream's subs are settled here, other stream groups settle their own
+        self.subreddit_names = [subreddit_name.lower() for subreddit_name in subreddit_names]
+        # called with [(latest action, number of earlier actions on the post it replaced)] once their window ends
+        self.on_settled = on_settled
+        self.debounce_secs = debounce_secs
+        # kept on disk so removals which were still waiting are acted on after a restart
+        self.connection.execute("CREATE TABLE IF NOT EXISTS pending_removals ("
+                                "target_fullname TEXT PRIMARY KEY, "
+                                "subreddit TEXT NOT NULL, "
+                                "action TEXT NOT NULL, "
+                                "created_utc REAL NOT NULL, "
+                                "due_utc REAL NOT NULL, "
+                                "collapsed_count INTEGER NOT NULL DEFAULT 0)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS pending_removals_by_due ON pending_removals (due_utc)")
+        self.connection.commit()
+        self.settle_thread = threading.Thread(target=self.settle_forever, name="RemovalDebouncer", daemon=True)
+        self.settle_thread.start()
+        metrics.set_gauge("queue_depth", self.depth, queue="pending_removals",
+                          subreddits="+".join(self.subreddit_names))
+
+    def submit(self, action):
+        # the window starts at a post's first action, later ones only replace which action is acted on
+        with self.lock:
+            self.connection.execute("INSERT INTO pending_removals VALUES (?, ?, ?, ?, ?, 0) "
+                                    "ON CONFLICT (target_fullname) DO UPDATE SET "
+                                    "collapsed_count = collapsed_count + 1, "
+                                    "action = CASE WHEN excluded.created_utc >= created_utc "
+                                    "THEN excluded.action ELSE action END, "
+                                    "created_utc = MAX(excluded.created_utc, created_utc)",
+                                    (action.target_fullname, action.subreddit.lower(),
+                                     json.dumps(dataclasses.asdict(action)), action.created_utc,
+                                     time.time() + self.debounce_secs))
+            self.connection.commit()
+
+    def take_settled(self):
+        placeholders = ", ".join("?" * len(self.subreddit_names))
+        with self.lock:
+            rows = self.connection.execute(f"SELECT target_fullname, action, collapsed_count FROM pending_removals "
+                                           f"WHERE due_utc <= ? AND subreddit IN ({placeholders}) "
+                                           f"ORDER BY created_utc",
+                                           [time.time()] + self.subreddit_names).fetchall()
+            self.connection.executemany("DELETE FROM pending_removals WHERE target_fullname = ?",
+                                        [(target_fullname,) for target_fullname, _, _ in rows])
+            self.connection.commit()
+        settled = list()
+        for target_fullname, action, collapsed_count in rows:
+            fields = json.loads(action)
+            # rows written before a field was dropped from the record still load
+            action = ModActionRecord(**{field.name: fields[field.name]
+                                        for field in dataclasses.fields(ModActionRecord)})
+            if collapsed_count:
+                print(f"Collapsed {collapsed_count + 1} removal actions on {target_fullname} into {action.action}")
+                metrics.inc("collapsed_total", collapsed_count, queue="pending_removals")
+            settled.append((action, collapsed_count))
+        return settled
+
+    def settle_forever(self):
+        while True:
+            time.sleep(self.CHECK_INTERVAL_SECS)
+            try:
+                settled = self.take_settled()
+                if settled:
+                    self.on_settled(settled)
+            except Exception as e:
+                message = f"Exception when settling debounced removals: {e}\n```{traceback.format_exc()}```"
+                self.discord_client.send_error_msg(message)
+                print(message)
+
+    def depth(self):
+        placeholders = ", ".join("?" * len(self.subreddit_names))
+        with self.lock:
+            return self.connection.execute(f"SELECT COUNT(*) FROM pending_removals WHERE subreddit IN ({placeholders})",
+                                           self.subreddit_names).fetchone()[0]
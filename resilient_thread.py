@@ -1,37 +1,123 @@
+import random
 import threading
 import traceback
 import time
 
-retry_wait_time_secs = 30
+# the worker running a ResilientThread's target, so heartbeat() knows who is calling it
+_worker = threading.local()
+
+
+class StaleWorkerError(Exception):
+    # raised in a worker which was given up on as stalled, once it finally wakes up
+    pass
+
+
+def heartbeat(quiet_secs=0):
+    # called by targets after every poll, even an empty one. quiet_secs is how long the target is about to
+    # deliberately wait, e.g. sleeping between polls, which shouldn't count as a stall
+    supervisor = getattr(_worker, 'supervisor', None)
+    if supervisor:
+        supervisor.beat(_worker.generation, quiet_secs)
 
 
 class ResilientThread(threading.Thread):
-    def __init__(self, discord_client, name, target=None, args=()):
+    # restarts when the target raises, returns, or stops calling heartbeat() for this long
+    STALL_TIMEOUT_SECS = 5 * 60
+    CHECK_INTERVAL_SECS = 5
+    INITIAL_BACKOFF_SECS = 1
+    MAX_BACKOFF_SECS = 2 * 60
+    # a worker which stayed up this long was healthy, its restart starts again from the initial backoff
+    HEALTHY_RUN_SECS = 10 * 60
+
+    def __init__(self, discord_client, name, target=None, args=(), stall_timeout_secs=STALL_TIMEOUT_SECS):
         super(ResilientThread, self).__init__()
         self.stop_event = threading.Event()
+        self.restart_event = threading.Event()
         self.discord_client = discord_client
         self.name = name
         self.target = target
         self.args = args
+        self.stall_timeout_secs = stall_timeout_secs
+        self.lock = threading.Lock()
+        # a stalled worker can't be killed, it's abandoned and exits at its next heartbeat as its generation is stale
+        self.generation = 0
+        self.deadline = 0
 
     def run(self):
-        while not self.stop_event.wait(30):
-            try:
-                if self.target:
-                    self.target(*self.args)
-            except Exception as e:
-                message = f"Exception in ResilientThread {self.name}: {e}\n```{traceback.format_exc()}```"
+        failures = 0
+        while not self.stop_event.is_set():
+            started = time.monotonic()
+            with self.lock:
+                self.generation += 1
+                self.deadline = started + self.stall_timeout_secs
+                generation = self.generation
+            worker = threading.Thread(target=self.work, args=(generation,), name=f"{self.name}-{generation}",
+                                      daemon=True)
+            worker.start()
+            self.supervise(worker)
+            if self.stop_event.is_set():
+                with self.lock:
+                    self.generation += 1
+                return
+
+            failures = self.next_failures(failures, started)
+            backoff_secs = self.backoff_secs(failures)
+            print(f"Restarting ResilientThread {self.name} in {backoff_secs:.1f} seconds")
+            self.stop_event.wait(backoff_secs)
+
+    @classmethod
+    def next_failures(cls, failures, started):
+        # consecutive failures of a worker started at this monotonic time which just exited
+        return 0 if time.monotonic() - started >= cls.HEALTHY_RUN_SECS else failures + 1
+
+    @classmethod
+    def backoff_secs(cls, failures):
+        # full jitter, so streams which failed together don't all hit reddit again at the same moment
+        return random.uniform(0, min(cls.INITIAL_BACKOFF_SECS * 2 ** failures, cls.MAX_BACKOFF_SECS))
+
+    def supervise(self, worker):
+        self.restart_event.clear()
+        while True:
+            if self.stop_event.wait(self.CHECK_INTERVAL_SECS) or not worker.is_alive():
+                return
+            with self.lock:
+                stalled_secs = time.monotonic() - self.deadline
+            if self.restart_event.is_set():
+                print(f"Restarting ResilientThread {self.name}...")
+            elif stalled_secs > 0:
+                message = f"ResilientThread {self.name} has had no heartbeat for " \
+                          f"{self.stall_timeout_secs + stalled_secs:.0f} seconds, restarting it"
                 self.discord_client.send_error_msg(message)
                 print(message)
-                time.sleep(retry_wait_time_secs)
+            else:
+                continue
+            # abandon the worker, it exits at its next heartbeat
+            with self.lock:
+                self.generation += 1
+            return
+
+    def work(self, generation):
+        _worker.supervisor = self
+        _worker.generation = generation
+        try:
+            if self.target:
+                self.target(*self.args)
+        except StaleWorkerError:
+            print(f"Abandoned {self.name} worker {generation} woke up and exited")
+        except Exception as e:
+            message = f"Exception in ResilientThread {self.name}: {e}\n```{traceback.format_exc()}```"
+            self.discord_client.send_error_msg(message)
+            print(message)
+
+    def beat(self, generation, quiet_secs):
+        with self.lock:
+            if generation != self.generation:
+                raise StaleWorkerError()
+            self.deadline = time.monotonic() + quiet_secs + self.stall_timeout_secs
 
     def stop(self):
         self.stop_event.set()
 
     def restart(self):
-        print(f"Restarting ResilientThread {self.name}...")
-        self.stop()
-        if self.is_alive():
-            self.join()
-        new_thread = ResilientThread(self.discord_client, self.name, self.target, self.args)
-        new_thread.start()
+        # abandons the current worker and starts a new one
+        self.restart_event.set()
@@ -0,0 +1,77 @@
+import threading
+import time
+import traceback
+
+from sqlite_store import SqliteStore
+
+
+class ShadowbanLedger(SqliteStore):
+    COOLDOWN_SECS = 7 * 24 * 60 * 60
+    ROLLUP_INTERVAL_SECS = 60 * 60
+
+    def __init__(self, discord_client, path, on_rollup, cooldown_secs=COOLDOWN_SECS,
+                 rollup_interval_secs=ROLLUP_INTERVAL_SECS):
+        super(ShadowbanLedger, self).__init__(path)
+        self.discord_client = discord_client
+        # called with {subreddit: [(user, suppressed count, latest permalink)]} for users who kept commenting
+        self.on_rollup = on_rollup
+        self.cooldown_secs = cooldown_secs
+        self.rollup_interval_secs = rollup_interval_secs
+        # the last full notice per user, and their comments since which only get a rolled up mention
+        self.connection.execute("CREATE TABLE IF NOT EXISTS shadowban_notices ("
+                                "subreddit TEXT NOT NULL, "
+                                "user TEXT NOT NULL, "
+                                "notified_utc REAL NOT NULL, "
+                                "suppressed_count INTEGER NOT NULL DEFAULT 0, "
+                                "latest_permalink TEXT, "
+                                "PRIMARY KEY (subreddit, user))")
+        self.connection.commit()
+        self.rollup_thread = threading.Thread(target=self.rollup_forever, name="ShadowbanRollup", daemon=True)
+        self.rollup_thread.start()
+
+    def should_notify(self, subreddit_name, user, permalink):
+        # True at most once per cooldown per user and sub, other comments are counted towards the next rollup
+        key = (subreddit_name.lower(), user.lower())
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute("SELECT notified_utc FROM shadowban_notices "
+                                          "WHERE subreddit = ? AND user = ?", key).fetchone()
+            if row is None or now - row[0] >= self.cooldown_secs:
+                self.connection.execute("INSERT OR REPLACE INTO shadowban_notices VALUES (?, ?, ?, 0, NULL)",
+                                        key + (now,))
+                notify = True
+            else:
+                self.connection.execute("UPDATE shadowban_notices "
+                                        "SET suppressed_count = suppressed_count + 1, latest_permalink = ? "
+                                        "WHERE subreddit = ? AND user = ?", (permalink,) + key)
+                notify = False
+            self.connection.commit()
+        return notify
+
+    def take_rollups(self):
+        rollups = dict()
+        with self.lock:
+            rows = self.connection.execute("SELECT subreddit, user, suppressed_count, latest_permalink "
+                                           "FROM shadowban_notices WHERE suppressed_count > 0 "
+                                           "ORDER BY subreddit, suppressed_count DESC").fetchall()
+            self.connection.execute("UPDATE shadowban_notices SET suppressed_count = 0, latest_permalink = NULL "
+                                    "WHERE suppressed_count > 0")
+            # users past their cooldown get a full notice next time anyway
+            self.connection.execute("DELETE FROM shadowban_notices WHERE notified_utc < ?",
+                                    (time.time() - self.cooldown_secs,))
+            self.connection.commit()
+        for subreddit_name, user, suppressed_count, latest_permalink in rows:
+            rollups.setdefault(subreddit_name, list()).append((user, suppressed_count, latest_permalink))
+        return rollups
+
+    def rollup_forever(self):
+        while True:
+            time.sleep(self.rollup_interval_secs)
+            try:
+                rollups = self.take_rollups()
+                if rollups:
+                    self.on_rollup(rollups)
+            except Exception as e:
+                message = f"Exception when rolling up shadowban notices: {e}\n```{traceback.format_exc()}```"
+                self.discord_client.send_error_msg(message)
+                print(message)
@@ -0,0 +1,21 @@
+import sqlite3
+import threading
+
+
+class SqliteStore:
+    # one connection shared by every thread using the store, always used while holding the lock
+
+    def __init__(self, path, pragmas=()):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        # set before WAL, e.g. auto_vacuum, which only takes effect on a new file
+        for pragma in pragmas:
+            self.connection.execute(f"PRAGMA {pragma}")
+        # WAL keeps the frequent small writes cheap and readers unblocked
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,142 @@
+import multiprocessing
+import os
+import signal
+
+from resilient_thread import ResilientThread, heartbeat
+
+# processes are spawned rather than forked, the parent already has discord, sqlite and reddit threads running
+PROCESS_CONTEXT = multiprocessing.get_context("spawn")
+
+
+class StreamGroup:
+    # subreddits which share one mod log stream and one comment stream, optionally with their own reddit account
+    def __init__(self, name, subreddit_names, credentials):
+        self.name = name
+        self.subreddit_names = subreddit_names
+        # (client id, client secret, bot username, bot password)
+        self.credentials = credentials
+        # fraction of the account's rate limit budget this group may use, split evenly between the groups on it
+        self.budget_share = 1
+
+    @property
+    def username(self):
+        return self.credentials[2].lower()
+
+    @staticmethod
+    def parse(groups_config, subreddit_names, default_credentials):
+        # groups_config is e.g. "collapse,ufos;news", subreddits in no group share one last group. group n uses the
+        # STREAM_GROUP_<n>_CLIENT_ID, _CLIENT_SECRET, _BOT_USERNAME and _BOT_PASSWORD env vars when set
+        known_names = {subreddit_name.lower(): subreddit_name for subreddit_name in subreddit_names}
+        grouped = list()
+        for group_config in groups_config.split(";"):
+            group_names = [name.strip() for name in group_config.split(",") if name.strip()]
+            for name in group_names:
+                if name.lower() not in known_names:
+                    raise ValueError(f"Stream group subreddit {name} is not in SUBREDDITS")
+            if group_names:
+                grouped.append([known_names[name.lower()] for name in group_names])
+        seen = [name.lower() for group_names in grouped for name in group_names]
+        if len(seen) != len(set(seen)):
+            raise ValueError(f"A subreddit is in more than one stream group: {groups_config}")
+        ungrouped = [name for name in subreddit_names if name.lower() not in seen]
+        if ungrouped:
+            grouped.append(ungrouped)
+
+        groups = [StreamGroup(f"group{i}", group_names, StreamGroup.credentials_for(i, default_credentials))
+                  for i, group_names in enumerate(grouped, start=1)]
+        # reddit budgets are per account, groups sharing an account get an equal part of it
+        for group in groups:
+            group.budget_share = 1 / sum(1 for other in groups if other.username == group.username)
+        return groups
+
+    @staticmethod
+    def credentials_for(index, default_credentials):
+        keys = ["CLIENT_ID", "CLIENT_SECRET", "BOT_USERNAME", "BOT_PASSWORD"]
+        return tuple(os.environ.get(f"STREAM_GROUP_{index}_{key}", default)
+                     for key, default in zip(keys, default_credentials))
+
+    def state_path(self, path):
+        # each group process keeps its own state file, e.g. bot_state-group1.db
+        root, extension = os.path.splitext(path)
+        return f"{root}-{self.name}{extension}"
+
+    def __str__(self):
+        return f"{self.name} ({'+'.join(self.subreddit_names)} as u/{self.credentials[2]}, " \
+               f"{self.budget_share:.0%} of its budget)"
+
+
+class DiscordRelay:
+    # stands in for the DiscordClient in group processes, messages are sent by the parent's client
+    def __init__(self, relay_queue):
+        self.relay_queue = relay_queue
+        self.mod_action_store = None
+
+    def send_msg(self, guild_name, channel_name, message):
+        self.relay_queue.put(("send_msg", (guild_name, channel_name, message)))
+
+    def send_error_msg(self, message):
+        self.relay_queue.put(("send_error_msg", (message,)))
+
+    def set_outbound_journal(self, outbound_journal):
+        # relayed messages are journaled by the parent if discord fails them
+        pass
+
+    @staticmethod
+    def forward_forever(relay_queue, discord_client):
+        # run in the parent
+        while True:
+            method, args = relay_queue.get()
+            try:
+                getattr(discord_client, method)(*args)
+            except Exception as e:
+                print(f"Failed to forward relayed discord message: {e}")
+
+
+class StreamGroupProcess:
+    # runs target(group, relay_queue) in its own process, restarted with backoff whenever it exits
+    CHECK_INTERVAL_SECS = 5
+    STOP_TIMEOUT_SECS = 30
+
+    def __init__(self, discord_client, group, target, relay_queue):
+        self.group = group
+        self.target = target
+        self.relay_queue = relay_queue
+        self.process = None
+        self.thread = ResilientThread(discord_client, f"{group.name}-Process", target=self.run_process)
+
+    def start(self):
+        self.thread.start()
+
+    def run_process(self):
+        self.process = PROCESS_CONTEXT.Process(target=self.target, args=(self.group, self.relay_queue),
+                                               name=f"StreamGroup-{self.group.name}")
+        self.process.start()
+        print(f"Started {self.group} in process {self.process.pid}")
+        try:
+            while self.process.is_alive():
+                heartbeat()
+                self.process.join(self.CHECK_INTERVAL_SECS)
+        finally:
+            if self.process.is_alive():
+                self.process.terminate()
+        if self.thread.stop_event.is_set():
+            return
+        raise RuntimeError(f"Stream group process {self.group.name} exited with code {self.process.exitcode}")
+
+    def stop(self):
+        # the process flushes buffered rows and the toxicity cache on SIGTERM before exiting
+        self.thread.stop()
+        if self.process and self.process.is_alive():
+            self.process.terminate()
+            self.process.join(self.STOP_TIMEOUT_SECS)
+
+    @staticmethod
+    def handle_signals():
+        # called first thing in a group process. ctrl-c is handled by the parent, which then sends SIGTERM once
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, StreamGroupProcess.on_sigterm)
+
+    @staticmethod
+    def on_sigterm(signum, frame):
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        raise KeyboardInterrupt()
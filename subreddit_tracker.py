@@ -1,8 +1,12 @@
-import calendar
-from datetime import datetime, timedelta
+import threading
 
 
 class SubredditTracker:
+    # the roster is also refreshed as soon as the mod log shows a mod team change
+    ROSTER_REFRESH_SECS = 24 * 60 * 60
+    ROSTER_RETRY_SECS = 60
+    ROSTER_LOAD_TIMEOUT_SECS = 60
+
     def __init__(self, reddit, subreddit, subreddit_wilds, subreddit_removals,
                  comment_mod_permissions, comment_mod_whitelist,
                  discord_removals_server, discord_removals_channel,
@@ -23,28 +27,46 @@ class SubredditTracker:
         self.discord_shadowbans_channel = discord_shadowbans_channel
         self.should_message_shadowbans = should_message_shadowbans
 
-        # detect last bot action in preference: wilds last post > removals last post > now
-        # required as streams provide last 100 of stream on startup, ensure no duplication
-        self.time_last_checked = next(subreddit_wilds.new()).created_utc if subreddit_wilds else \
-            next(subreddit_removals.new()).created_utc if subreddit_removals \
-            else calendar.timegm(datetime.utcnow().utctimetuple())
-        self.comment_mods_last_check = datetime.utcfromtimestamp(0)
-        self.cached_comment_mods = self.get_comment_mods()
+        # comment mods are refreshed in the background, so removals never wait on the moderator listing
+        self.comment_mods = frozenset()
+        self.comment_mods_loaded = threading.Event()
+        self.comment_mods_invalidated = threading.Event()
+        self.roster_thread = threading.Thread(target=self.refresh_comment_mods_forever,
+                                              name=f"{self.subreddit_name}-Roster", daemon=True)
+        self.roster_thread.start()
 
     def get_comment_mods(self):
-        # refresh comment mods every day
-        if datetime.utcnow() - self.comment_mods_last_check < timedelta(days=1):
-            return self.cached_comment_mods
+        # only blocks until the first load, or for a bounded time if reddit is down at startup
+        self.comment_mods_loaded.wait(self.ROSTER_LOAD_TIMEOUT_SECS)
+        return self.comment_mods
+
+    def invalidate_comment_mods(self):
+        # called when the mod log shows the mod team changed
+        self.comment_mods_invalidated.set()
+
+    def refresh_comment_mods_forever(self):
+        while True:
+            # cleared before the refresh, so changes during it trigger another
+            self.comment_mods_invalidated.clear()
+            try:
+                self.refresh_comment_mods()
+                wait_secs = self.ROSTER_REFRESH_SECS
+            except Exception as e:
+                print(f"Failed to refresh comment mods for {self.subreddit_name}: {e}")
+                wait_secs = self.ROSTER_RETRY_SECS
+            self.comment_mods_invalidated.wait(wait_secs)
 
-        mods = list()
+    def refresh_comment_mods(self):
+        mods = set()
         comment_mod_perms = set(self.comment_mod_permissions)
         comment_mod_whitelist = set(self.comment_mod_whitelist)
-        for moderator in self.subreddit.moderator():
+        # built here, so the listing is fetched with this thread's reddit instance
+        for moderator in self.reddit.subreddit(self.subreddit_name).moderator():
             if moderator.name in comment_mod_whitelist:
                 continue
             if set(moderator.mod_permissions) == comment_mod_perms:
-                mods.append(moderator.name)
-        self.comment_mods_last_check = datetime.utcnow()
-        self.cached_comment_mods = mods
-        print(f"Refreshed comment mods for {self.subreddit_name}: {mods}")
-        return mods
+                mods.add(moderator.name)
+        # swapped in whole, readers never see a partially built roster
+        self.comment_mods = frozenset(mods)
+        self.comment_mods_loaded.set()
+        print(f"Refreshed comment mods for {self.subreddit_name}: {sorted(mods)}")
@@ -0,0 +1,20 @@
+import threading
+
+
+class ThreadLocalReddit:
+    # praw.Reddit isn't thread safe, its session and rate limiter are shared by every request. this stands in for
+    # one, giving each thread which uses it its own instance. objects it returns belong to the calling thread's
+    # instance, so anything which might fetch should be built on the thread which uses it
+
+    def __init__(self, create_reddit):
+        self.create_reddit = create_reddit
+        self.local = threading.local()
+
+    def get(self):
+        reddit = getattr(self.local, 'reddit', None)
+        if reddit is None:
+            reddit = self.local.reddit = self.create_reddit()
+        return reddit
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
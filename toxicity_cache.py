@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+
+class ToxicityCache:
+    MAX_SIZE = 20000
+    TTL_SECS = 7 * 24 * 60 * 60
+    SAVE_INTERVAL_SECS = 5 * 60
+
+    def __init__(self, max_size=MAX_SIZE, ttl_secs=TTL_SECS, path=None):
+        self.max_size = max_size
+        self.ttl_secs = ttl_secs
+        # optional file to persist scores to, so restarts keep the cache warm
+        self.path = path
+        # text hash -> (time scored as epoch secs, score), ordered least to most recently used
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        # only one save writes the temp file at a time
+        self.save_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.api_calls = 0
+        self.api_latency_total_secs = 0.0
+        self.last_save_time = time.monotonic()
+        if self.path:
+            self.load()
+
+    @staticmethod
+    def normalize(text):
+        # copies of the same text often only differ by case and whitespace
+        return re.sub(r'\s+', ' ', text).strip().lower()
+
+    def key_for(self, text):
+        return hashlib.sha256(self.normalize(text).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is not None and entry[0] + self.ttl_secs < time.time():
+                del self.cache[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, score, api_latency_secs):
+        with self.lock:
+            self.api_calls += 1
+            self.api_latency_total_secs += api_latency_secs
+            self.cache[key] = (time.time(), score)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+            should_save = self.path and time.monotonic() - self.last_save_time > self.SAVE_INTERVAL_SECS
+            if should_save:
+                # claimed here, so the other workers don't also decide to save
+                self.last_save_time = time.monotonic()
+        if should_save:
+            try:
+                self.save()
+            except Exception as e:
+                # the score is still good, failing to persist it mustn't stop the comment being reported
+                print(f"Unable to save toxicity cache to {self.path}: {e}")
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            avg_latency_secs = self.api_latency_total_secs / self.api_calls if self.api_calls else 0
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0,
+                'size': len(self.cache),
+                'avg_api_latency_secs': avg_latency_secs,
+                # every hit is an api call which didn't have to be made
+                'saved_secs': self.hits * avg_latency_secs,
+            }
+
+    def stats_summary(self):
+        stats = self.stats()
+        return f"Toxicity cache: {stats['hits']} hits, {stats['misses']} misses " \
+               f"({round(stats['hit_rate'] * 100)}% hit rate), {stats['size']} entries, " \
+               f"~{round(stats['saved_secs'])}s of api calls saved"
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Unable to load toxicity cache from {self.path}: {e}")
+            return
+        now = time.time()
+        with self.lock:
+            for key, (scored_time, score) in entries.items():
+                if scored_time + self.ttl_secs >= now:
+                    self.cache[key] = (scored_time, score)
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+        print(f"Loaded {len(self.cache)} toxicity scores from {self.path}")
+
+    def save(self):
+        if not self.path:
+            return
+        with self.save_lock:
+            with self.lock:
+                entries = dict(self.cache)
+                self.last_save_time = time.monotonic()
+            # write then rename so a crash mid-write never leaves a corrupt cache file
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, 'w') as f:
+                json.dump(entries, f)
+            os.replace(temp_path, self.path)
@@ -0,0 +1,162 @@
+import argparse
+import json
+import re
+import threading
+import zlib
+
+import numpy as np
+
+
+class ToxicityPrefilter:
+    # comments the local model scores below this are never sent to the toxicity API
+    BENIGN_THRESHOLD = 0.2
+    CHAR_NGRAM_SIZE = 3
+
+    def __init__(self, weights, bias, benign_threshold=BENIGN_THRESHOLD):
+        self.weights = np.asarray(weights, dtype=np.float32)
+        self.bias = float(bias)
+        self.n_features = len(self.weights)
+        self.benign_threshold = benign_threshold
+        self.lock = threading.Lock()
+        self.skipped_count = 0
+        self.escalated_count = 0
+
+    @staticmethod
+    def load(path, benign_threshold=BENIGN_THRESHOLD):
+        # weights file is an .npz with a "weights" array (one per hashed feature) and a scalar "bias"
+        data = np.load(path)
+        print(f"Loaded toxicity prefilter with {len(data['weights'])} features from {path}")
+        return ToxicityPrefilter(data['weights'], data['bias'], benign_threshold)
+
+    @staticmethod
+    def features(text, n_features):
+        # hashed word unigrams/bigrams and character trigrams, so unseen words still share signal
+        # returns the distinct feature indices and their l2 normalized counts
+        text = re.sub(r'\s+', ' ', text).strip().lower()
+        words = re.findall(r"[\w']+", text)
+        grams = [f"w:{word}" for word in words]
+        grams += [f"b:{first} {second}" for first, second in zip(words, words[1:])]
+        size = ToxicityPrefilter.CHAR_NGRAM_SIZE
+        grams += [f"c:{text[i:i + size]}" for i in range(len(text) - size + 1)]
+        hashes = np.fromiter((zlib.crc32(gram.encode('utf-8')) % n_features for gram in grams),
+                             dtype=np.int64, count=len(grams))
+        indices, counts = np.unique(hashes, return_counts=True)
+        values = counts.astype(np.float32)
+        return indices, values / max(float(np.linalg.norm(values)), 1.0)
+
+    @staticmethod
+    def vectorize(texts, n_features):
+        # sparse batch as flat (row, feature index, value) arrays, avoiding a dense texts x features matrix
+        features = [ToxicityPrefilter.features(text, n_features) for text in texts]
+        rows = np.concatenate([np.full(len(indices), row) for row, (indices, _) in enumerate(features)])
+        indices = np.concatenate([indices for indices, _ in features])
+        values = np.concatenate([values for _, values in features])
+        return rows, indices, values
+
+    @staticmethod
+    def logits(batch, n_texts, weights, bias):
+        rows, indices, values = batch
+        return np.bincount(rows, weights=weights[indices] * values, minlength=n_texts) + bias
+
+    def score_batch(self, texts):
+        if not texts:
+            return np.zeros(0, dtype=np.float32)
+        batch = self.vectorize(texts, self.n_features)
+        return 1 / (1 + np.exp(-self.logits(batch, len(texts), self.weights, self.bias)))
+
+    def score(self, text):
+        return float(self.score_batch([text])[0])
+
+    def is_benign(self, text):
+        benign = self.score(text) < self.benign_threshold
+        with self.lock:
+            if benign:
+                self.skipped_count += 1
+            else:
+                self.escalated_count += 1
+        return benign
+
+    def stats_summary(self):
+        with self.lock:
+            total = self.skipped_count + self.escalated_count
+            skip_rate = self.skipped_count / total if total else 0
+            return f"Toxicity prefilter: {self.skipped_count} skipped, {self.escalated_count} escalated " \
+                   f"({round(skip_rate * 100)}% of api calls avoided)"
+
+
+def read_labeled(path):
+    # one json object per line: {"text": "...", "score": <toxicity API score, 0 when not flagged>}
+    texts = list()
+    scores = list()
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                texts.append(entry['text'])
+                scores.append(float(entry['score']))
+    return texts, np.asarray(scores, dtype=np.float32)
+
+
+def train(labeled_path, weights_path, n_features, report_threshold, epochs, learning_rate):
+    texts, scores = read_labeled(labeled_path)
+    labels = (scores > report_threshold).astype(np.float32)
+    batch = ToxicityPrefilter.vectorize(texts, n_features)
+    rows, indices, values = batch
+    weights = np.zeros(n_features, dtype=np.float32)
+    bias = 0.0
+    # plain batch gradient descent on logistic loss
+    for _ in range(epochs):
+        predictions = 1 / (1 + np.exp(-ToxicityPrefilter.logits(batch, len(texts), weights, bias)))
+        error = predictions - labels
+        gradient = np.bincount(indices, weights=error[rows] * values, minlength=n_features)
+        weights -= (learning_rate * gradient / len(texts)).astype(np.float32)
+        bias -= learning_rate * float(error.mean())
+    np.savez(weights_path, weights=weights, bias=np.float32(bias))
+    print(f"Trained on {len(texts)} comments ({int(labels.sum())} toxic), saved weights to {weights_path}")
+
+
+def evaluate(labeled_path, weights_path, benign_threshold, report_threshold):
+    # replays labeled comments to see how many api calls would be skipped and at what cost
+    texts, scores = read_labeled(labeled_path)
+    prefilter = ToxicityPrefilter.load(weights_path, benign_threshold)
+    benign = prefilter.score_batch(texts) < benign_threshold
+    reported = scores > report_threshold
+    skipped = int(benign.sum())
+    # comments the api would have reported, but the prefilter never sent to it
+    missed = int((benign & reported).sum())
+    # comments escalated to the api which it did not report
+    wasted = int((~benign & ~reported).sum())
+    total = len(texts)
+    print(f"Comments: {total}, reported by api: {int(reported.sum())}")
+    print(f"Skipped api calls: {skipped} ({round(skipped / max(total, 1) * 100, 1)}%)")
+    print(f"Disagreements (skipped but api reported): {missed} "
+          f"({round(missed / max(int(reported.sum()), 1) * 100, 1)}% of reports missed)")
+    print(f"Escalated but not reported: {wasted}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train or evaluate the local toxicity prefilter offline")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    train_parser = subparsers.add_parser('train', help="fit weights from labeled comments")
+    train_parser.add_argument('labeled_path')
+    train_parser.add_argument('weights_path')
+    train_parser.add_argument('--features', type=int, default=2 ** 18)
+    train_parser.add_argument('--report-threshold', type=float, default=0.85)
+    train_parser.add_argument('--epochs', type=int, default=200)
+    train_parser.add_argument('--learning-rate', type=float, default=5.0)
+    eval_parser = subparsers.add_parser('eval', help="replay labeled comments against existing weights")
+    eval_parser.add_argument('labeled_path')
+    eval_parser.add_argument('weights_path')
+    eval_parser.add_argument('--benign-threshold', type=float, default=ToxicityPrefilter.BENIGN_THRESHOLD)
+    eval_parser.add_argument('--report-threshold', type=float, default=0.85)
+    args = parser.parse_args()
+
+    if args.command == 'train':
+        train(args.labeled_path, args.weights_path, args.features, args.report_threshold, args.epochs,
+              args.learning_rate)
+    else:
+        evaluate(args.labeled_path, args.weights_path, args.benign_threshold, args.report_threshold)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+import queue
+import threading
+import traceback
+
+from metrics import metrics
+
+
+class ToxicityScorer:
+    # what to do with a new comment when the queue is full
+    DROP_NEWEST = "drop_newest"  # discard the new comment
+    DROP_OLDEST = "drop_oldest"  # discard the oldest queued comment to make room for the new one
+    BLOCK = "block"  # wait up to block_timeout_secs for room (slowing the stream), then discard the new comment
+    DROP_POLICIES = [DROP_NEWEST, DROP_OLDEST, BLOCK]
+
+    def __init__(self, discord_client, handler, num_workers=4, max_queue_size=500, drop_policy=DROP_OLDEST,
+                 block_timeout_secs=5, subreddits=''):
+        if drop_policy not in self.DROP_POLICIES:
+            raise ValueError(f"drop_policy must be one of {self.DROP_POLICIES}")
+        self.discord_client = discord_client
+        # handler is called with each comment on a worker thread
+        self.handler = handler
+        self.drop_policy = drop_policy
+        self.block_timeout_secs = block_timeout_secs
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.dropped_count = 0
+        self.lock = threading.Lock()
+        self.workers = [threading.Thread(target=self.work_forever, name=f"ToxicityScorer-{i}", daemon=True)
+                        for i in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+        # each stream group's comment stream has its own scorer
+        metrics.set_gauge("queue_depth", self.queue.qsize, queue="toxicity", subreddits=subreddits)
+
+    def submit(self, comment):
+        # never blocks the stream unless drop_policy is BLOCK, returns whether the comment was queued
+        if self.drop_policy == self.BLOCK:
+            try:
+                self.queue.put(comment, timeout=self.block_timeout_secs)
+                return True
+            except queue.Full:
+                self.record_drop(comment)
+                return False
+
+        while True:
+            try:
+                self.queue.put_nowait(comment)
+                return True
+            except queue.Full:
+                if self.drop_policy == self.DROP_NEWEST:
+                    self.record_drop(comment)
+                    return False
+            try:
+                self.record_drop(self.queue.get_nowait())
+                self.queue.task_done()
+            except queue.Empty:
+                pass
+
+    def record_drop(self, comment):
+        with self.lock:
+            self.dropped_count += 1
+            dropped_count = self.dropped_count
+        metrics.inc("dropped_total", queue="toxicity")
+        print(f"Toxicity queue full, dropped comment {comment.id} ({dropped_count} dropped total)")
+
+    def work_forever(self):
+        while True:
+            comment = self.queue.get()
+            try:
+                self.handler(comment)
+            except Exception as e:
+                message = f"Exception when scoring comment {comment.id}: {e}\n```{traceback.format_exc()}```"
+                self.discord_client.send_error_msg(message)
+                print(message)
+            finally:
+                self.queue.task_done()